@@ -0,0 +1,483 @@
+import argparse
+import os
+import tempfile
+import time
+import pandas as pd
+import torch
+
+from text_encoder import compare_text_encoders
+from sublayer_new import MultiHeadAttention, FusedMultiHeadAttention
+from model_new import Transformer
+from metrics import MetricAccumulator
+from loss import cal_loss, cca_loss, wasserstein_1d, wasserstein_loss
+from precision import autocast
+from parallel import set_thread_budget
+from test_loss import reference_cca_loss
+from export import trace_transformer, CompiledTransformer, export_onnx, check_onnx_parity, OnnxTransformer
+from config import d_model, d_inner, d_k, d_v, class_num, EEG_LEN, TEXT_LEN, outdim_size
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=None)
+    parser.add_argument('--bench', type=str, help="Please choose a benchmark from the following list: ['text_llm', 'mha', 'attention', 'precision', 'compiled', 'onnx', 'checkpointing', 'fusion_parallel', 'cca', 'wd', 'cca_memory', 'metrics']")
+    parser.add_argument('--num_threads', type = int, default = 2, help = 'Number of intra-op threads torch uses')
+    parser.add_argument('--interop_threads', type = int, default = 0)
+    parser.add_argument('--text_llm', type=str, default = 'bert-int8', help = 'text_llm compared against fp32 bert')
+    parser.add_argument('--num_sentences', type = int, default = 256, help = 'Number of ZuCo sentences to encode')
+    parser.add_argument('--batch_size', type = int, default = 32)
+    parser.add_argument('--seq_len', type = int, default = EEG_LEN, help = 'Sequence length fed to the attention layers (832 for EEG, 768 for text)')
+    parser.add_argument('--num_heads', type = int, default = 1)
+    parser.add_argument('--iters', type = int, default = 20, help = 'Timed iterations per variant')
+    parser.add_argument('--device', type = str, default = 'cpu')
+    parser.add_argument('--seq_lens', type = str, default = '832,1600', help = 'Comma-separated sequence lengths for --bench attention')
+    parser.add_argument('--attention_window', type = int, default = 32)
+    # --- Transformer options, as in main_new.py
+    parser.add_argument('--modality', type = str, default = 'fusion')
+    parser.add_argument('--num_layers', type = int, default = 1)
+    parser.add_argument('--dropout', type = float, default = 0.3)
+    parser.add_argument('--attention', type = str, default = 'dense')
+    parser.add_argument('--fused_attention', type = int, default = 0)
+    parser.add_argument('--eeg_tokens', type = str, default = 'scalar')
+    parser.add_argument('--precision', type = str, default = 'fp32')
+    parser.add_argument('--checkpoint_layers', type = int, default = 0)
+    parser.add_argument('--pad_masks', type = int, default = 1)
+    parser.add_argument('--fusion_parallel', type = int, default = 0)
+    parser.add_argument('--batch_sizes', type = str, default = '8,32,64,256', help = 'Comma-separated batch sizes for --bench cca')
+    parser.add_argument('--layer_counts', type = str, default = '1,4,8', help = 'Comma-separated num_layers for --bench checkpointing')
+    parser.add_argument('--loss', type = str, default = 'CE')
+    parser.add_argument('--ce_weight', type = float, default = 1)
+    parser.add_argument('--cca_weight', type = float, default = 1)
+    parser.add_argument('--cca_memory', type = str, default = 'none')
+    parser.add_argument('--cca_momentum', type = float, default = 0.9)
+    parser.add_argument('--cca_queue_size', type = int, default = 1024)
+    parser.add_argument('--wd_weight', type = float, default = 1)
+    parser.add_argument('--wd_projections', type = int, default = 0)
+    return parser.parse_args()
+
+
+def bench_text_llm(args):
+    sentences = pd.read_csv('data/sentiment_labels_clean.csv').sentence.tolist()[:args.num_sentences]
+    result = compare_text_encoders(sentences, args.text_llm, reference='bert', batch_size=args.batch_size)
+    print(f'Encoded {len(sentences)} sentences')
+    print(f"bert:          {result['reference_seconds']:.2f} s")
+    print(f"{args.text_llm}: {result['candidate_seconds']:.2f} s ({result['speedup']:.2f}x)")
+    print(f"cosine similarity to bert: mean {result['cosine_mean']:.4f}, min {result['cosine_min']:.4f}")
+
+
+def time_step(step, iters, device, warmup=3):
+    """
+        Args: step() runs one iteration, warmup untimed iterations first (TorchScript optimizes on the first runs)
+        Return: mean seconds per iteration and peak CUDA memory in MB (None on cpu)
+    """
+    for _ in range(warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    seconds = (time.time() - start) / iters
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else None
+    return seconds, peak
+
+
+def build_transformer(args, device):
+    torch.manual_seed(0)
+    model = Transformer(device=device, d_feature_text=TEXT_LEN, d_feature_eeg=EEG_LEN, d_model=d_model, d_inner=d_inner,
+                        n_layers=args.num_layers, n_head=args.num_heads, d_k=d_k, d_v=d_v, dropout=args.dropout,
+                        class_num=class_num, args=args)
+    return model.to(device)
+
+
+def random_batch(args, device):
+    generator = torch.Generator().manual_seed(1)
+    return {
+        'sentence': torch.randn(args.batch_size, TEXT_LEN, generator=generator).to(device),
+        'seq': torch.randn(args.batch_size, EEG_LEN, generator=generator).to(device),
+        'label': torch.randint(0, class_num, (args.batch_size,), generator=generator).to(device)
+    }
+
+
+def forward_loss(model, batch, args):
+    """
+        Args: Transformer, batch as produced by random_batch
+        Return: logits and loss of the batch for args.modality
+    """
+    if args.modality == 'text':
+        pred = model(text_src_seq = batch['sentence'])
+        loss, _ = cal_loss(batch['label'], args, pred = pred)
+    elif args.modality == 'eeg':
+        pred = model(eeg_src_seq = batch['seq'])
+        loss, _ = cal_loss(batch['label'], args, pred = pred)
+    else:
+        pred, eeg_embed, text_embed = model(eeg_src_seq = batch['seq'], text_src_seq = batch['sentence'])
+        loss, _ = cal_loss(batch['label'], args, pred = pred, text_embed = text_embed, eeg_embed = eeg_embed)
+    return pred, loss
+
+
+def bench_precision(args):
+    device = torch.device(args.device)
+    batch = random_batch(args, device)
+    logits = {}
+    for precision in ['fp32', 'bf16']:
+        args.precision = precision
+        model = build_transformer(args, device)
+
+        model.eval()
+        with torch.no_grad(), autocast(args, device):
+            logits[precision] = forward_loss(model, batch, args)[0].float()
+
+        model.train()
+
+        def step():
+            with autocast(args, device):
+                _, loss = forward_loss(model, batch, args)
+            loss.backward()
+
+        seconds, peak = time_step(step, args.iters, device)
+        memory = f', peak {peak:.0f} MB' if peak is not None else ''
+        print(f'{precision}: {args.batch_size / seconds:.1f} samples/s training{memory}')
+
+    agreement = (logits['fp32'].argmax(1) == logits['bf16'].argmax(1)).float().mean().item()
+    print(f"bf16 vs fp32: max |logit difference| {(logits['fp32'] - logits['bf16']).abs().max().item():.2e}, "
+          f'same predicted class for {agreement * 100:.1f}% of the batch')
+
+
+def bench_compiled(args):
+    device = torch.device(args.device)
+    batch = random_batch(args, device)
+    model = build_transformer(args, device).eval()
+    compiled = CompiledTransformer(trace_transformer(model, args.modality, args.batch_size), args.modality)
+
+    outputs = {}
+    for name, runner in [('eager', model), ('compiled', compiled)]:
+        def step():
+            with torch.no_grad():
+                outputs[name] = forward_loss(runner, batch, args)[0]
+
+        seconds, _ = time_step(step, args.iters, device)
+        print(f'{name:8s} {seconds * 1000:.2f} ms per batch of {args.batch_size}')
+    print(f"max |output difference| {(outputs['eager'] - outputs['compiled']).abs().max().item():.2e}")
+
+
+def bench_onnx(args):
+    from onnx_runner import OnnxModel
+
+    device = torch.device('cpu')
+    batch = random_batch(args, device)
+    model = build_transformer(args, device).eval()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f'{args.modality}.onnx')
+        inputs, outputs = export_onnx(model, args.modality, path, args.batch_size)
+        print(f'parity: max |onnxruntime - PyTorch| {check_onnx_parity(path, args.modality, inputs, outputs):.2e}')
+        onnx_model = OnnxTransformer(OnnxModel(path, args.num_threads), device)
+
+        for name, runner in [('PyTorch', model), ('onnxruntime', onnx_model)]:
+            def step():
+                with torch.no_grad():
+                    forward_loss(runner, batch, args)
+
+            seconds, _ = time_step(step, args.iters, device)
+            print(f'{name:12s} {args.batch_size / seconds:8.1f} samples/s ({seconds * 1000:.2f} ms per batch of {args.batch_size})')
+
+
+def saved_tensor_mb(fn):
+    """
+        Args: fn() runs a forward pass
+        Return: MB of activations autograd keeps alive for backward (device independent peak-memory proxy)
+    """
+    sizes = {}
+
+    def pack(tensor):
+        sizes[(tensor.untyped_storage().data_ptr(), tensor.dtype)] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(sizes.values()) / 2 ** 20
+
+
+def bench_fusion_parallel(args):
+    device = torch.device(args.device)
+    args.modality = 'fusion'
+    batch = random_batch(args, device)
+    print(f'{args.num_threads} threads, {torch.get_num_interop_threads()} inter-op threads')
+    outputs = {}
+    for fusion_parallel in [0, 1]:
+        args.fusion_parallel = fusion_parallel
+        model = build_transformer(args, device)
+        compiled = CompiledTransformer(trace_transformer(model, args.modality, args.batch_size), args.modality)
+
+        for name, runner in [('eager', model), ('compiled', compiled)]:
+            def step():
+                with torch.no_grad():
+                    outputs[(name, fusion_parallel)] = forward_loss(runner, batch, args)[0]
+
+            seconds, _ = time_step(step, args.iters, device)
+            print(f'fusion_parallel={fusion_parallel} {name:8s} inference {seconds * 1000:8.2f} ms per batch of {args.batch_size}')
+
+        model.train()
+
+        def step():
+            _, loss = forward_loss(model, batch, args)
+            loss.backward()
+
+        seconds, _ = time_step(step, args.iters, device)
+        print(f'fusion_parallel={fusion_parallel} eager    training  {seconds * 1000:8.2f} ms per step')
+
+    diff = max((outputs[(name, 0)] - outputs[(name, 1)]).abs().max().item() for name in ['eager', 'compiled'])
+    print(f'max |output difference| sequential vs parallel {diff:.2e}')
+
+
+def bench_cca(args):
+    device = torch.device(args.device)
+
+    # Correctness (gradcheck, eigh reference, small batches) is asserted in test_loss.py
+    cca = cca_loss(outdim_size, False)
+    cca64 = cca_loss(outdim_size, False, float64=True)
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        generator = torch.Generator().manual_seed(batch_size)
+        shared = torch.randn(batch_size, d_model, generator=generator)
+        H1 = (shared + torch.randn(batch_size, d_model, generator=generator)).to(device).requires_grad_()
+        H2 = (shared + torch.randn(batch_size, d_model, generator=generator)).to(device).requires_grad_()
+
+        reference = reference_cca_loss(H1.double(), H2.double(), outdim_size).item()
+        seconds = {}
+        for name, loss_fn in [('reference', lambda: reference_cca_loss(H1, H2, outdim_size)),
+                              ('cholesky', lambda: cca.loss(H1, H2)),
+                              ('cholesky float64', lambda: cca64.loss(H1, H2))]:
+            value = loss_fn().item()
+
+            def step():
+                loss_fn().backward()
+
+            seconds[name], _ = time_step(step, args.iters, device)
+            print(f'batch {batch_size:4d} {name:16s} {seconds[name] * 1000:7.3f} ms forward+backward, '
+                  f'|loss - float64 reference| {abs(value - reference):.2e}')
+        print(f"batch {batch_size:4d} speedup {seconds['reference'] / seconds['cholesky']:.2f}x")
+
+
+def bench_cca_memory(args):
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+    # Two views sharing a low-dimensional signal, so the population canonical correlations are known up to sampling
+    mixing1, mixing2 = torch.randn(outdim_size, d_model, generator=generator), torch.randn(outdim_size, d_model, generator=generator)
+
+    def sample(m):
+        shared = torch.randn(m, outdim_size, generator=generator)
+        H1 = torch.matmul(shared, mixing1) + torch.randn(m, d_model, generator=generator)
+        H2 = torch.matmul(shared, mixing2) + torch.randn(m, d_model, generator=generator)
+        return H1.to(device), H2.to(device)
+
+    population = cca_loss(outdim_size, False).loss(*sample(100000)).item()
+    print(f'population CCA loss {population:.4f}')
+    n_steps = max(args.iters, 100)
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        batches = [sample(batch_size) for _ in range(n_steps)]
+        for memory in ['none', 'ema', 'queue']:
+            cca = cca_loss(outdim_size, False, memory=memory, momentum=args.cca_momentum, queue_size=args.cca_queue_size)
+            start = time.time()
+            losses = []
+            for H1, H2 in batches:
+                H1.requires_grad_()
+                loss = cca.loss(H1, H2)
+                loss.backward()
+                losses.append(loss.item())
+            seconds = (time.time() - start) / n_steps
+            # Skip the steps that fill the memory bank
+            losses = torch.tensor(losses[n_steps // 2:])
+            print(f'batch {batch_size:4d} {memory:5s} loss {losses.mean().item():8.4f} +- {losses.std().item():.4f}, '
+                  f'|mean - population| {abs(losses.mean().item() - population):.4f}, {seconds * 1000:.3f} ms per step')
+
+
+def bench_metrics(args):
+    from sklearn.metrics import confusion_matrix
+
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+    n_steps = max(args.iters, 100)
+    batches = [(torch.randn(args.batch_size, class_num, generator=generator).to(device),
+                torch.randint(0, class_num, (args.batch_size,), generator=generator).to(device)) for _ in range(n_steps)]
+
+    def per_step():
+        # The previous loop: copies to numpy and a confusion matrix over the whole epoch so far on every step
+        all_labels, all_res, all_pred = [], [], []
+        total_correct = 0
+        for pred, label in batches:
+            all_labels.extend(label.cpu().numpy())
+            all_res.extend(pred.max(1)[1].cpu().numpy())
+            all_pred.extend(pred.cpu().detach().numpy())
+            total_correct += pred.max(1)[1].eq(label).sum().item()
+            cm = confusion_matrix(all_labels, all_res)
+        return total_correct, cm
+
+    def accumulated():
+        metrics = MetricAccumulator(device, n_steps * args.batch_size, keep_predictions=True)
+        for pred, label in batches:
+            metrics.update(pred, label)
+        return metrics.result()
+
+    start = time.time()
+    total_correct, cm = per_step()
+    per_step_seconds = time.time() - start
+    start = time.time()
+    _, n_correct, accumulated_cm, _, _ = accumulated()
+    accumulated_seconds = time.time() - start
+    print(f'{n_steps} steps of batch {args.batch_size}: per-step numpy + confusion_matrix {per_step_seconds * 1000:.1f} ms, '
+          f'MetricAccumulator {accumulated_seconds * 1000:.1f} ms ({per_step_seconds / accumulated_seconds:.1f}x)')
+    print(f'same correct count: {total_correct == n_correct}, same confusion matrix: {(cm == accumulated_cm).all()}')
+
+
+def bench_wd(args):
+    from scipy.stats import wasserstein_distance
+
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(0)
+    for n_u, n_v in [(100, 100), (100, 37)]:
+        u, v = torch.randn(n_u, generator=generator), 2 * torch.randn(n_v, generator=generator) + 1
+        difference = abs(wasserstein_1d(u.double(), v.double()).item() - wasserstein_distance(u.numpy(), v.numpy()))
+        print(f'{n_u} vs {n_v} samples: |torch - scipy| {difference:.2e}')
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        text_embed = torch.randn(batch_size, d_model, generator=generator).to(device).requires_grad_()
+        eeg_embed = torch.randn(batch_size, d_model, generator=generator).to(device).requires_grad_()
+
+        def scipy_step():
+            # The previous WD term: a sync and a copy to the cpu, and no gradient
+            return torch.tensor(wasserstein_distance(text_embed.cpu().detach().numpy().flatten(),
+                                                     eeg_embed.cpu().detach().numpy().flatten()), requires_grad=True)
+
+        def torch_step():
+            loss = wasserstein_loss(text_embed, eeg_embed, args)
+            loss.backward()
+            return loss
+
+        scipy_seconds, _ = time_step(scipy_step, args.iters, device)
+        torch_seconds, _ = time_step(torch_step, args.iters, device)
+        text_embed.grad = None
+        torch_step()
+        print(f'batch {batch_size:4d}: scipy {scipy_seconds * 1000:.3f} ms (forward only), '
+              f'torch {torch_seconds * 1000:.3f} ms forward+backward, |gradient| {text_embed.grad.norm().item():.2e}')
+
+
+def peak_cpu_mb(fn):
+    ''' Peak MB of cpu memory allocated by torch while fn() runs, above what was allocated before '''
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted([e for e in prof.events() if e.self_cpu_memory_usage != 0], key=lambda e: e.time_range.start)
+    current, peak = 0, 0
+    for event in events:
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak / 2 ** 20
+
+
+def bench_checkpointing(args):
+    device = torch.device(args.device)
+    batch = random_batch(args, device)
+    for num_layers in [int(n) for n in args.layer_counts.split(',')]:
+        args.num_layers = num_layers
+        grads = {}
+        for checkpoint_layers in [0, 1]:
+            args.checkpoint_layers = checkpoint_layers
+            model = build_transformer(args, device).train()
+
+            def step():
+                model.zero_grad(set_to_none=True)
+                _, loss = forward_loss(model, batch, args)
+                loss.backward()
+
+            torch.manual_seed(0)  # same dropout masks with and without checkpointing
+            step()
+            grads[checkpoint_layers] = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+            if device.type == 'cuda':
+                _, peak = time_step(step, 1, device, warmup=0)
+            else:
+                peak = peak_cpu_mb(step)
+            seconds, _ = time_step(step, args.iters, device)
+            print(f'{num_layers} layers, checkpoint_layers={checkpoint_layers}: {seconds * 1000:8.1f} ms per step, '
+                  f'peak {peak:7.1f} MB')
+        grad_diff = max((a - b).abs().max().item() for a, b in zip(grads[0], grads[1]))
+        print(f'{num_layers} layers: max |gradient difference| {grad_diff:.2e}')
+
+
+def bench_attention(args):
+    device = torch.device(args.device)
+    for seq_len in [int(l) for l in args.seq_lens.split(',')]:
+        x = torch.randn(args.batch_size, seq_len, d_model, device=device)
+        dense_output = None
+        for attention in ['dense', 'local', 'linear']:
+            torch.manual_seed(0)
+            module = MultiHeadAttention(args.num_heads, d_model, d_k, d_v, 0.0, seq_len,
+                                        attention, args.attention_window).to(device)
+            module.eval()
+            with torch.no_grad():
+                output = module(x, x, x)[0]
+            if dense_output is None:
+                dense_output = output
+            deviation = ((output - dense_output).norm() / dense_output.norm()).item()
+
+            module.train()
+            _, activation_mb = saved_tensor_mb(lambda: module(x, x, x)[0])
+
+            def step():
+                module(x, x, x)[0].sum().backward()
+
+            seconds, peak = time_step(step, args.iters, device)
+            memory = f', peak {peak:.0f} MB' if peak is not None else ''
+            print(f'L={seq_len:5d} {attention:6s} {args.batch_size / seconds:8.1f} sequences/s, '
+                  f'saved activations {activation_mb:7.1f} MB{memory}, relative deviation from dense {deviation:.3f}')
+
+
+def bench_mha(args):
+    device = torch.device(args.device)
+    reference = MultiHeadAttention(args.num_heads, d_model, d_k, d_v, 0.0, args.seq_len).to(device)
+    fused = FusedMultiHeadAttention(args.num_heads, d_model, d_k, d_v, 0.0, args.seq_len).to(device)
+    fused.load_state_dict(reference.state_dict())
+    x = torch.randn(args.batch_size, args.seq_len, d_model, device=device)
+
+    outputs = {}
+    for name, module in [('MultiHeadAttention', reference), ('FusedMultiHeadAttention', fused)]:
+        module.train()
+        module.zero_grad()
+        torch.manual_seed(0)  # same attention dropout in both
+        outputs[name] = module(x, x, x)[0]
+        outputs[name].sum().backward()
+
+        def step():
+            module(x, x, x)[0].sum().backward()
+
+        seconds, peak = time_step(step, args.iters, device)
+        memory = f', peak {peak:.0f} MB' if peak is not None else ''
+        print(f'{name:24s} forward+backward {seconds * 1000:.1f} ms{memory}')
+
+    grads = fused.fuse_state_dict({name: p.grad for name, p in reference.named_parameters()})
+    grad_diff = max((grads[name] - getattr(fused, name).grad).abs().max().item() for name in grads)
+    print(f"max |output difference| {(outputs['MultiHeadAttention'] - outputs['FusedMultiHeadAttention']).abs().max().item():.2e}")
+    print(f'max |gradient difference| {grad_diff:.2e}')
+
+
+if __name__ == '__main__':
+    args = get_args()
+    set_thread_budget(args)
+
+    benches = {
+        'text_llm' : bench_text_llm,
+        'mha' : bench_mha,
+        'attention' : bench_attention,
+        'precision' : bench_precision,
+        'compiled' : bench_compiled,
+        'onnx' : bench_onnx,
+        'checkpointing' : bench_checkpointing,
+        'fusion_parallel' : bench_fusion_parallel,
+        'cca' : bench_cca,
+        'wd' : bench_wd,
+        'cca_memory' : bench_cca_memory,
+        'metrics' : bench_metrics,
+    }
+    benches[args.bench](args)
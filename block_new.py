@@ -2,7 +2,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from sublayer_new import MultiHeadAttention
+import functools
+import contextlib
+from torch.utils.checkpoint import checkpoint
+from sublayer_new import MultiHeadAttention, FusedMultiHeadAttention
 from config import PAD
 
 class PositionwiseFeedForward(nn.Module):
@@ -24,18 +27,23 @@ class PositionwiseFeedForward(nn.Module):
         return output
 
 
-def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
+@functools.lru_cache(maxsize=None)
+def _sinusoid_table(n_position, d_hid):
+    position = np.arange(n_position)[:, None]
+    hid_idx = np.arange(d_hid)[None, :]
+    sinusoid_table = position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
 
-    def cal_angle(position, hid_idx):
-        return position / np.power(10000, 2 * (hid_idx // 2) / d_hid)
+    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2]) 
+    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2]) 
 
-    def get_posi_angle_vec(position):
-        return [cal_angle(position, hid_j) for hid_j in range(d_hid)]
+    sinusoid_table.setflags(write=False)
+    return sinusoid_table
 
-    sinusoid_table = np.array([get_posi_angle_vec(pos_i) for pos_i in range(n_position)])
 
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2]) 
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2]) 
+def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
+
+    # Built once per (n_position, d_hid); copied because nn.Embedding takes ownership of the tensor
+    sinusoid_table = _sinusoid_table(n_position, d_hid).copy()
 
     if padding_idx is not None:
 
@@ -46,11 +54,6 @@ def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
     return x
 
 
-def get_non_pad_mask(seq):
-    assert seq.dim() == 2
-    return seq.ne(PAD).type(torch.float).unsqueeze(-1)
-
-
 def get_subsequent_mask(seq):
 
     sz_b, len_s = seq.size()
@@ -61,29 +64,72 @@ def get_subsequent_mask(seq):
     return subsequent_mask
 
 
-def get_attn_key_pad_mask(seq_k, seq_q):
-
-    len_q = seq_q.size(1)
-    padding_mask = seq_k.eq(PAD)
-    padding_mask = padding_mask.unsqueeze(1).expand(-1, len_q, -1) 
-
-    return padding_mask
+def get_pad_masks(seq, pad_masks=1):
+    '''
+        non_pad_mask and slf_attn_mask for seq, or (None, None) when pad_masks is 0 (inputs known to hold no PAD) so masking is skipped.
+        Decided per model and not per batch, so a forward never reads device values back to the host.
+        seq is b x l scalars or b x l x features tokens; a token is padding when all its features are PAD.
+    '''
+    if not pad_masks:
+        return None, None
+    padding = seq.eq(PAD)
+    if seq.dim() == 3:
+        padding = padding.all(dim=-1)
+    return (~padding).type(torch.float).unsqueeze(-1), padding.unsqueeze(1)
     
     
 class EncoderLayer(nn.Module):
 
-    def __init__(self, d_model, d_inner, n_head, d_k, d_v, dropout, d_feature):
+    def __init__(self, d_model, d_inner, n_head, d_k, d_v, dropout, d_feature, fused_attention=0,
+                 attention='dense', attention_window=32):
         super(EncoderLayer, self).__init__()
-        self.slf_attn = MultiHeadAttention(
-            n_head, d_model, d_k, d_v, dropout, d_feature)
+        multi_head = FusedMultiHeadAttention if fused_attention else MultiHeadAttention
+        self.slf_attn = multi_head(
+            n_head, d_model, d_k, d_v, dropout, d_feature, attention, attention_window)
         self.pos_ffn = PositionwiseFeedForward(d_model, d_inner, dropout,)
 
     def forward(self, enc_input, non_pad_mask=None, slf_attn_mask=None):
         enc_output, enc_slf_attn = self.slf_attn(
             enc_input, enc_input, enc_input, mask=slf_attn_mask)
-        enc_output *= non_pad_mask
+        if non_pad_mask is not None:
+            enc_output *= non_pad_mask
 
         enc_output = self.pos_ffn(enc_output)
-        enc_output *= non_pad_mask
+        if non_pad_mask is not None:
+            enc_output *= non_pad_mask
 
         return enc_output, enc_slf_attn
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    ''' Puts back the BatchNorm running statistics of module, which a checkpointed layer would otherwise update twice (forward and recompute) '''
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in batch_norms]
+    try:
+        yield
+    finally:
+        for m, (running_mean, running_var, num_batches_tracked) in zip(batch_norms, stats):
+            m.running_mean.copy_(running_mean)
+            m.running_var.copy_(running_var)
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def run_layer_stack(layer_stack, enc_output, non_pad_mask=None, slf_attn_mask=None, checkpoint_layers=0):
+    """
+        Args: nn.ModuleList of EncoderLayer, b x l x d_model input, masks of get_pad_masks
+        Return: output of the last layer. With checkpoint_layers, while training, every layer keeps only its input
+                for backward and recomputes its attention activations there (dropout masks are replayed)
+    """
+    checkpointed = checkpoint_layers and layer_stack.training and torch.is_grad_enabled()
+    for enc_layer in layer_stack:
+        if checkpointed:
+            enc_output, _ = checkpoint(
+                enc_layer, enc_output, non_pad_mask, slf_attn_mask, use_reentrant=False,
+                context_fn=lambda layer=enc_layer: (contextlib.nullcontext(), frozen_batchnorm_stats(layer)))
+        else:
+            enc_output, _ = enc_layer(
+                enc_output,
+                non_pad_mask=non_pad_mask,
+                slf_attn_mask=slf_attn_mask)
+    return enc_output
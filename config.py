@@ -16,6 +16,9 @@ d_v = 64
 
 Fea_PLUS = 2
 EEG_LEN = 832
+# --- ZuCo sentence EEG is EEG_BANDS frequency bands x EEG_ELECTRODES electrodes, band-major (EEG_LEN values)
+EEG_BANDS = 8
+EEG_ELECTRODES = 104
 TEXT_LEN = 768
 # SIG_LEN3 = 6
 
@@ -64,6 +67,17 @@ SIG_LEN3 = 6
 MAX_LEN = 32
 PRE_TRAINED_MODEL_NAME = 'bert-base-uncased'
 
+# --- Known transcription errors in the ZuCo .mat sentence content -> sentence in the label csv
+SENTENCE_CORRECTIONS = {
+    'Ultimately feels emp11111ty and unsatisfying, like swallowing a Communion wafer without the wine.':
+        'Ultimately feels empty and unsatisfying, like swallowing a Communion wafer without the wine.',
+    "Bullock's complete lack of focus and ability quickly derails the film.1":
+        "Bullock's complete lack of focus and ability quickly derails the film.",
+}
+
+# --- On-disk caches (sentence embeddings, preprocessed EEG)
+CACHE_DIR = 'data/cache'
+
 # --- For K-EmoCon, pick from [happy_trans, happy2_trans, angry_trans, 
 #                               angry2_trans, sad_trans, sad2_trans, nervous_trans, nervous2_trans]
 # if {emotion}_trans pick eeg with delta0
@@ -98,6 +112,10 @@ patient = 'ZAB'
 
 outdim_size = class_num
 use_all_singular_values = False
+# Whiten and decompose the CCA covariances in float64 (slower, for badly conditioned batches)
+cca_float64 = False
+# Seed of the random directions of the sliced Wasserstein loss (--wd_projections), independent of torch's global RNG
+wd_projection_seed = 0
 
 torchload3 = 'Name of Model (.chkpt)'
 
@@ -1,6 +1,6 @@
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import torch.nn as nn
 from config import *
 import scipy.stats as stats
@@ -10,7 +10,13 @@ import math
 from tqdm import tqdm
 from scipy.stats import zscore
 import random
-from transformers import BertModel, BertTokenizer, BertForSequenceClassification
+import unicodedata
+import re
+import shutil
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from text_encoder import SentenceEmbeddingStore, get_tokenizer
 from collections import defaultdict
 
 
@@ -79,237 +85,351 @@ class Text_EEGDataset(Dataset):
     return signal, text, torch.tensor(label, dtype=torch.long)
   
   
-def prepare_sr_eeg_data(sr_eeg_data_path, sentence_list, labels_list, sentence_ids_list, args):
-  
-  eeg_dict = {}
-  
-  count = 0
+# --- Band order of the 832-d sentence EEG vector
+SR_BANDS = ['t1', 't2', 'a1', 'a2', 'b1', 'b2', 'g1', 'g2']
+SR_SKIPPED_FILES = ['resultsZDN_SR.mat']
+# --- Bump whenever the layout of the cached arrays changes
+SR_CACHE_VERSION = 3
+
+
+def load_sr_subject(file_path):
+  """
+      Args: path to one subject's results*_SR.mat
+      Return: list of sentences and float32 array (n_sentences, 8, 104) of their band vectors.
+              Sentences with an all-NaN band are dropped, remaining NaNs are kept.
+  """
+  io_mat_file = io.loadmat(file_path, squeeze_me=True, struct_as_record=False)['sentenceData']
   
-  for i in tqdm(os.listdir(sr_eeg_data_path), desc = 'Creating SR EEG dataset: '):
-      
-      file_path = os.path.join(sr_eeg_data_path,i)
-      
-      if file_path == 'data/SR/resultsZDN_SR.mat':
-        pass
-      
-      else:
-        
-        io_mat_file = io.loadmat(file_path, squeeze_me=True, struct_as_record=False)['sentenceData']
-
-        for j in range(len(io_mat_file)):
-          
-          t1 = io_mat_file[j].mean_t1[:104]
-          t2 = io_mat_file[j].mean_t2[:104]
-          
-          a1 = io_mat_file[j].mean_a1[:104]
-          a2 = io_mat_file[j].mean_a2[:104]
-
-          g1 = io_mat_file[j].mean_g1[:104]
-          g2 = io_mat_file[j].mean_g2[:104]
-          
-          b1 = io_mat_file[j].mean_b1[:104]
-          b2 = io_mat_file[j].mean_b2[:104]
-          
-          nan_mask_t1 = np.isnan(t1)
-          nan_mask_t2 = np.isnan(t2)
-          
-          nan_mask_a1 = np.isnan(a1)
-          nan_mask_a2 = np.isnan(a2)
-          
-          nan_mask_b1 = np.isnan(b1)
-          nan_mask_b2 = np.isnan(b2)
-          
-          nan_mask_g1 = np.isnan(g1)
-          nan_mask_g2 = np.isnan(g2)
-          
-          if np.all(nan_mask_t1) or np.all(nan_mask_t2) or np.all(nan_mask_a1) or np.all(nan_mask_a2) \
-            or np.all(nan_mask_b1) or np.all(nan_mask_b2) or np.all(nan_mask_g1) or np.all(nan_mask_g2):
-
-            pass
-          
-          else:
-            t1[nan_mask_t1] = 0
-            t2[nan_mask_t2] = 0
-            
-            a1[nan_mask_a1] = 0
-            a2[nan_mask_a2] = 0
-            
-            b1[nan_mask_b1] = 0
-            b2[nan_mask_b2] = 0
-            
-            g1[nan_mask_g1] = 0
-            g2[nan_mask_g2] = 0
-            
-          
-            sentence = io_mat_file[j].content
-            
-            if sentence == 'Ultimately feels emp11111ty and unsatisfying, like swallowing a Communion wafer without the wine.':
-                sentence = 'Ultimately feels empty and unsatisfying, like swallowing a Communion wafer without the wine.'
-            elif sentence == "Bullock's complete lack of focus and ability quickly derails the film.1":
-                sentence =  "Bullock's complete lack of focus and ability quickly derails the film."
-            
-            sentence_idx = sentence_list.index(sentence)
-            
-            label = labels_list[sentence_idx]
-            if label == -1:
-              label = 2.0
-            
-            sentence_id = sentence_ids_list[sentence_idx]
-            
-            if sentence_id in eeg_dict:
-              
-              eeg_dict[sentence_id]['t1'].append(t1.tolist())
-              eeg_dict[sentence_id]['t2'].append(t2.tolist())
-              
-              eeg_dict[sentence_id]['a1'].append(a1.tolist())
-              eeg_dict[sentence_id]['a2'].append(a2.tolist())
-              
-              eeg_dict[sentence_id]['b1'].append(b1.tolist())
-              eeg_dict[sentence_id]['b2'].append(b2.tolist())
-              
-              eeg_dict[sentence_id]['g1'].append(g1.tolist())
-              eeg_dict[sentence_id]['g2'].append(g2.tolist())
-              
-              assert label == eeg_dict[sentence_id]['label']
-              
-              assert sentence == eeg_dict[sentence_id]['sentence']
-              
-            else:
-              
-                eeg_dict[sentence_id] = {
-                  'label' : label,
-                  'sentence' : sentence,
-                  't1' : [t1.tolist()],
-                  't2' : [t2.tolist()],
-                  'a1' : [a1.tolist()],
-                  'a2' : [a2.tolist()],
-                  'b1' : [b1.tolist()],
-                  'b2' : [b2.tolist()],
-                  'g1' : [g1.tolist()],
-                  'g2' : [g2.tolist()]
-                }
-                
-            assert (len(t1) == len(t2) == len(a1) == len(a2) == len(b1) \
-                == len(b2) == len(g1) == len(g2))
-      count +=1
-      if args.dev == 1:
-        if count == 1:
-          break  
-        
-  for k in eeg_dict.keys():
-    
-    t1 = np.array(eeg_dict[k]['t1'], dtype=np.float32)
-    t2 = np.array(eeg_dict[k]['t2'], dtype=np.float32)
+  sentences = []
+  bands = []
+  for j in range(len(io_mat_file)):
     
-    a1 = np.array(eeg_dict[k]['a1'], dtype=np.float32)
-    a2 = np.array(eeg_dict[k]['a2'], dtype=np.float32)
+    sentence_bands = np.stack([getattr(io_mat_file[j], 'mean_' + band)[:104] for band in SR_BANDS]).astype(np.float32)
+    nan_mask = np.isnan(sentence_bands)
     
-    b1 = np.array(eeg_dict[k]['b1'], dtype=np.float32)
-    b2 = np.array(eeg_dict[k]['b2'], dtype=np.float32)
+    if np.any(np.all(nan_mask, axis=1)):
+      continue
     
-    g1 = np.array(eeg_dict[k]['g1'], dtype=np.float32)
-    g2 = np.array(eeg_dict[k]['g2'], dtype=np.float32)
+    sentences.append(io_mat_file[j].content)
+    bands.append(sentence_bands)
     
-    mean_t1 = np.mean(t1, axis=0)
-    mean_t2 = np.mean(t2, axis=0)
-    
-    mean_a1 = np.mean(a1, axis=0)
-    mean_a2 = np.mean(a2, axis=0)
+  return sentences, np.array(bands, dtype=np.float32).reshape(-1, len(SR_BANDS), 104)
+
+
+def load_sr_subjects(files, num_workers=0):
+  """
+      Yields load_sr_subject(file) for every file, in order. With num_workers > 1 the files
+      are parsed concurrently in a process pool.
+  """
+  if num_workers > 1:
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+      for result in tqdm(executor.map(load_sr_subject, files), total=len(files), desc='Creating SR EEG dataset: '):
+        yield result
+  else:
+    for file_path in tqdm(files, desc='Creating SR EEG dataset: '):
+      yield load_sr_subject(file_path)
+
+
+def sr_subject_name(file_path):
+  match = re.match(r'results(.+)_SR\.mat$', os.path.basename(file_path))
+  return match.group(1) if match else os.path.splitext(os.path.basename(file_path))[0]
+
+
+def sr_subject_files(sr_eeg_data_path, args):
+  files = [os.path.join(sr_eeg_data_path, i) for i in sorted(os.listdir(sr_eeg_data_path)) if i not in SR_SKIPPED_FILES]
+  if args.dev == 1:
+    files = files[:1]
+  return files
+
+
+def file_digest(file_path, memo=None):
+  """
+      Content hash of a file. memo maps path -> [size, mtime_ns, digest] so unchanged files
+      are not re-read on every run.
+  """
+  stat = os.stat(file_path)
+  if memo is not None and file_path in memo and memo[file_path][:2] == [stat.st_size, stat.st_mtime_ns]:
+    return memo[file_path][2]
+  
+  sha = hashlib.sha1()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha.update(chunk)
+  digest = sha.hexdigest()
+  
+  if memo is not None:
+    memo[file_path] = [stat.st_size, stat.st_mtime_ns, digest]
+  return digest
+
+
+def sr_cache_key(files, sentence_list, labels_list, sentence_ids_list, *options):
+  memo_path = os.path.join(CACHE_DIR, 'file_digests.json')
+  memo = {}
+  if os.path.exists(memo_path):
+    with open(memo_path) as f:
+      memo = json.load(f)
+  
+  sha = hashlib.sha1(f'v{SR_CACHE_VERSION}'.encode('utf-8'))
+  for file_path in files:
+    sha.update(os.path.basename(file_path).encode('utf-8'))
+    sha.update(file_digest(file_path, memo).encode('utf-8'))
+  sha.update(json.dumps([sentence_list, labels_list, sentence_ids_list, options]).encode('utf-8'))
+  
+  os.makedirs(CACHE_DIR, exist_ok=True)
+  with open(memo_path, 'w') as f:
+    json.dump(memo, f)
+  return sha.hexdigest()
+
+
+def normalize_sentence(sentence):
+  return unicodedata.normalize('NFC', ' '.join(str(sentence).split()))
+
+
+class SentenceLabelIndex():
+  """
+      Hash index from normalized sentence text to its row in the label csv, with a correction
+      table for known transcription errors. Replaces the linear sentence_list.index() scan.
+  """
+  
+  def __init__(self, sentence_list, labels_list, sentence_ids_list, corrections=SENTENCE_CORRECTIONS):
+    self.sentence_list = sentence_list
+    self.labels_list = labels_list
+    self.sentence_ids_list = sentence_ids_list
+    self.corrections = {normalize_sentence(k): normalize_sentence(v) for k, v in corrections.items()}
     
-    mean_b1 = np.mean(b1, axis=0)
-    mean_b2 = np.mean(b2, axis=0)
+    self.index = {}
+    for i, sentence in enumerate(sentence_list):
+      # Keep the first occurrence, as list.index did
+      self.index.setdefault(normalize_sentence(sentence), i)
+      
+  def __len__(self):
+    return len(self.sentence_list)
+      
+  def row(self, sentence):
+    """
+        Return: row of the sentence in the label csv
+    """
+    key = normalize_sentence(sentence)
+    key = self.corrections.get(key, key)
+    if key not in self.index:
+      raise Exception(f'Sentence not found in the label csv: {sentence}')
+    return self.index[key]
+      
+
+class SentenceBandAccumulator():
+  """
+      Streaming, NaN-aware running sum and count of band vectors per sentence row, so ingestion
+      keeps O(sentences) memory however many subjects are added.
+  """
+  
+  def __init__(self, n_rows, n_bands=len(SR_BANDS), n_channels=104):
+    self.sums = np.zeros((n_rows, n_bands, n_channels), dtype=np.float64)
+    self.counts = np.zeros((n_rows, n_bands, n_channels), dtype=np.int32)
+    self.n_subjects = np.zeros(n_rows, dtype=np.int32)
     
-    mean_g1 = np.mean(g1, axis=0)
-    mean_g2 = np.mean(g2, axis=0)
+  def add(self, row, bands):
+    valid = ~np.isnan(bands)
+    self.sums[row] += np.where(valid, bands, 0)
+    self.counts[row] += valid
+    self.n_subjects[row] += 1
     
-    eeg_dict[k]['t1'] = zscore(mean_t1)
-    eeg_dict[k]['t2'] = zscore(mean_t2)
+  def add_subject(self, sums, counts, n_recordings):
+    """
+        Vectorized add of one subject's stored (n_rows, n_bands, n_channels) sums and counts.
+    """
+    self.sums += sums
+    self.counts += counts
+    self.n_subjects += n_recordings
     
-    eeg_dict[k]['a1'] = zscore(mean_a1)
-    eeg_dict[k]['a2'] = zscore(mean_a2)
+  def mean(self, skipna=False):
+    """
+        Return: float32 array (n_rows, n_bands, n_channels) of per-sentence means.
+                skipna=False treats NaNs as 0 and divides by the number of subjects (original behaviour),
+                skipna=True divides each value by the number of subjects that actually recorded it.
+    """
+    if skipna:
+      denominator = np.maximum(self.counts, 1)
+    else:
+      denominator = np.maximum(self.n_subjects, 1)[:, None, None]
+    return (self.sums / denominator).astype(np.float32)
+  
+  
+class SubjectBandCache():
+  """
+      Per-subject, per-sentence band sums (NaN -> 0) and valid-value counts, memory-mapped from
+      disk. Rows follow the label csv, so the mean over any subset of subjects is computed from
+      the stored arrays without touching the .mat files again.
+  """
+  
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'subjects.json')) as f:
+      self.subjects = json.load(f)
+    self.sums = np.load(os.path.join(path, 'sums.npy'), mmap_mode='r')
+    self.counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+    self.recordings = np.load(os.path.join(path, 'recordings.npy'))
     
-    eeg_dict[k]['b1'] = zscore(mean_b1)
-    eeg_dict[k]['b2'] = zscore(mean_b2)
+  @classmethod
+  def build(cls, path, files, label_index, num_workers=0):
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
     
-    eeg_dict[k]['g1'] = zscore(mean_g1)
-    eeg_dict[k]['g2'] = zscore(mean_g2)
+    shape = (len(files), len(label_index), len(SR_BANDS), 104)
+    sums = np.lib.format.open_memmap(os.path.join(tmp_path, 'sums.npy'), mode='w+', dtype=np.float32, shape=shape)
+    counts = np.lib.format.open_memmap(os.path.join(tmp_path, 'counts.npy'), mode='w+', dtype=np.uint8, shape=shape)
+    recordings = np.zeros(shape[:2], dtype=np.uint8)
     
+    for s, (file_sentences, file_bands) in enumerate(load_sr_subjects(files, num_workers)):
+      accumulator = SentenceBandAccumulator(len(label_index))
+      for sentence, sentence_bands in zip(file_sentences, file_bands):
+        accumulator.add(label_index.row(sentence), sentence_bands)
+      sums[s] = accumulator.sums
+      counts[s] = accumulator.counts
+      recordings[s] = accumulator.n_subjects
+      
+    sums.flush()
+    counts.flush()
+    del sums, counts
+    np.save(os.path.join(tmp_path, 'recordings.npy'), recordings)
+    with open(os.path.join(tmp_path, 'subjects.json'), 'w') as f:
+      json.dump([sr_subject_name(file_path) for file_path in files], f)
+      
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return cls(path)
+  
+  def subject_mean(self, subjects=None, skipna=False):
+    """
+        Args: subject names to average over (all if None)
+        Return: label csv rows recorded by at least one of the subjects, and their mean bands
+    """
+    if subjects is None:
+      subjects = self.subjects
+    for subject in subjects:
+      if subject not in self.subjects:
+        raise Exception(f'Subject {subject} is not in the EEG cache, pick from {self.subjects}')
+      
+    accumulator = SentenceBandAccumulator(self.recordings.shape[1])
+    for subject in subjects:
+      s = self.subjects.index(subject)
+      accumulator.add_subject(self.sums[s], self.counts[s], self.recordings[s])
+      
+    rows = np.flatnonzero(accumulator.n_subjects)
+    return rows, accumulator.mean(skipna)[rows]
+  
+  
+def select_subjects(subjects, args):
+  if args.eeg_subjects is not None:
+    subjects = args.eeg_subjects.split(',')
+  if args.exclude_subjects is not None:
+    excluded = args.exclude_subjects.split(',')
+    subjects = [subject for subject in subjects if subject not in excluded]
+  return subjects
+  
+  
+class SentenceEEGData():
+  """
+      Struct-of-arrays container for the sentence-level EEG. Row i holds the (8, 104) band
+      vectors, label, sentence_id and sentence of one sentence; index maps sentence_id -> row.
+  """
+  
+  def __init__(self, eeg, labels, sentence_ids, sentences):
+    self.eeg = eeg
+    self.labels = labels
+    self.sentence_ids = sentence_ids
+    self.sentences = sentences
+    self.index = {sentence_id: i for i, sentence_id in enumerate(sentence_ids.tolist())}
     
-  return eeg_dict
+  def __len__(self):
+    return len(self.labels)
+  
+
+def prepare_sr_eeg_data(sr_eeg_data_path, sentence_list, labels_list, sentence_ids_list, args):
+  
+  files = sr_subject_files(sr_eeg_data_path, args)
+  label_index = SentenceLabelIndex(sentence_list, labels_list, sentence_ids_list)
+  
+  cache_path = os.path.join(CACHE_DIR, f'sr_subjects_{sr_cache_key(files, sentence_list, labels_list, sentence_ids_list, SENTENCE_CORRECTIONS)}')
+  if args.eeg_cache == 1 and os.path.exists(cache_path):
+    print(f'Loading SR EEG subjects from {cache_path}')
+    cache = SubjectBandCache(cache_path)
+  else:
+    cache = SubjectBandCache.build(cache_path, files, label_index, args.ingest_workers)
+  
+  rows, eeg = cache.subject_mean(select_subjects(cache.subjects, args), skipna=args.eeg_skipna == 1)
+  eeg = zscore(eeg, axis=-1).astype(np.float32)
+  
+  labels = np.array(labels_list, dtype=np.int64)[rows]
+  labels[labels == -1] = 2
+  
+  return SentenceEEGData(eeg, labels, np.array(sentence_ids_list, dtype=np.int64)[rows], [sentence_list[row] for row in rows])
 
 
 class EEGDataset(Dataset):
-    def __init__(self, data, args):
+    def __init__(self, data, args, store=None, indices=None):
         self.data = data
         self.args = args
-        if self.args.text_llm == 'bert':
-            self.bert = BertModel.from_pretrained('bert-base-uncased')
-        elif self.args.text_llm == 'seqbert':
-          self.bert = BertForSequenceClassification.from_pretrained('bert-base-uncased')
-          
-        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.indices = np.arange(len(data)) if indices is None else np.asarray(indices)
+        # (N, 832) view over the contiguous (N, 8, 104) array, so __getitem__ is a single slice
+        # All per-sample data lives in tensors built here, so DataLoader workers only index them:
+        # shared copy-on-write under fork, and moved through shared memory under spawn
+        self.seq = torch.from_numpy(data.eeg.reshape(len(data), -1))
+        self.labels = torch.from_numpy(data.labels)
+        if self.args.model == 'transformer':
+          if store is None:
+            store = SentenceEmbeddingStore(self.args.text_llm)
+          sentences = [self.data.sentences[i] for i in self.indices]
+          self.embeddings = torch.from_numpy(store.lookup(sentences))
+        elif self.args.model == 'bert':
+          # Sentences are tokenized per batch by BertCollator
+          self.tokenizer = get_tokenizer()
 
     def __len__(self):
-        return len(self.data)
-      
-    def __getembed__(self, text):
-      tokenized = self.tokenizer(text, padding=True, truncation=True, return_tensors='pt')
-      input_ids = tokenized['input_ids']
-      if self.args.model == 'transformer':
-        with torch.no_grad():
-            outputs = self.bert(input_ids)
-            embeddings = outputs.last_hidden_state.mean(dim=1).squeeze().numpy()
-        
-        embeddings = zscore(embeddings)
-        
-        assert embeddings.shape == (768,)
-        
-        return torch.tensor(embeddings, dtype = torch.float32)
-      elif self.args.model == 'bert':
-        return input_ids
+        return len(self.indices)
+
+    def token_lengths(self):
+        """
+            Return: token count of every sentence in the split (args.model == 'bert'), for LengthBucketSampler.
+                    Tokenizes the whole split, so it is only called when --length_bucketing is on
+        """
+        sentences = [self.data.sentences[i] for i in self.indices]
+        return [len(input_ids) for input_ids in self.tokenizer(sentences, truncation=True)['input_ids']]
       
     def __getitem__(self, idx):
-        item = self.data[idx]
+        row = self.indices[idx]
         if self.args.model == 'transformer':
-          embeddings = self.__getembed__(item['sentence'])
+          embeddings = self.embeddings[idx]
+        elif self.args.model == 'bert':
+          embeddings = self.data.sentences[row]
         
         sample = {
-            'label': torch.tensor(item['label'], dtype=torch.long),
+            'label': self.labels[row],
             'sentence': embeddings,
-            # 'a1': item['a1'],
-            # 'a2': item['a2'],
-            # 't1': item['t1'],
-            # 't2': item['t2'],
-            # 'b1': item['b1'],
-            # 'b2': item['b2'],
-            # 'g1': item['g1'],
-            # 'g2': item['g2'],
-            'seq': torch.tensor(np.concatenate([item['t1'], item['t2'], item['a1'], item['a2'], \
-              item['b1'], item['b2'], item['g1'], item['g2']]), dtype=torch.float32)
+            'seq': self.seq[row]
         }
-        assert sample['seq'].shape == (832,)
 
         return sample
 
 
-def clean_dic(eeg_dict):
-  new_dict = {}
-  id_mapping = {}
-  count = 0
+def seed_worker(worker_id):
+    """
+        worker_init_fn for DataLoader: torch already seeds every worker differently,
+        derive the numpy and random seeds from it so augmentations do not repeat across workers.
+    """
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
 
-  for key, value in tqdm(eeg_dict.items(), desc = 'Cleaning Dictionary: '):
-      new_key = count
-      id_mapping[key] = new_key
-      new_dict[new_key] = value
-      count += 1
-  
-  return new_dict, id_mapping
 
-def shuffle_split_data(eeg_dict):
+def shuffle_split_data(data):
+    """
+        Args: SentenceEEGData
+        Return: train, val and test row indices (60/10/30 per label)
+    """
     label_keys = defaultdict(list)
-    for key, value in eeg_dict.items():
-        label = value['label']  
-        label_keys[label].append(key)
+    for row, label in enumerate(data.labels.tolist()):
+        label_keys[label].append(row)
 
     for label in label_keys:
         random.shuffle(label_keys[label])
@@ -318,20 +438,75 @@ def shuffle_split_data(eeg_dict):
     train_proportion = {label: int(0.6 * count) for label, count in label_counts.items()}
     val_proportion = {label: int(0.10 * count) for label, count in label_counts.items()}
 
-    train_data = {}
-    val_data = {}
-    test_data = {}
+    train_idx = []
+    val_idx = []
+    test_idx = []
 
     for label in label_keys:
         keys = label_keys[label]
-        for i, key in tqdm(enumerate(keys), desc=f'Splitting Dictionary (Label: {label})'):
-            value = eeg_dict[key]
-            if i < train_proportion[label]:
-                train_data[key] = value
-            elif train_proportion[label] <= i < train_proportion[label] + val_proportion[label]:
-                val_data[key] = value
-            else:
-                test_data[key] = value
-
-    return train_data, val_data, test_data
-  
+        train_idx.extend(keys[:train_proportion[label]])
+        val_idx.extend(keys[train_proportion[label]:train_proportion[label] + val_proportion[label]])
+        test_idx.extend(keys[train_proportion[label] + val_proportion[label]:])
+
+    return np.array(train_idx, dtype=np.int64), np.array(val_idx, dtype=np.int64), np.array(test_idx, dtype=np.int64)
+
+
+class BertCollator():
+    """
+        collate_fn for args.model == 'bert': tokenizes the whole batch with the fast tokenizer,
+        pads to the longest sentence in the batch and returns the attention mask with it.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def __call__(self, samples):
+        return {
+            'label': torch.stack([sample['label'] for sample in samples]),
+            'sentence': self.tokenizer([sample['sentence'] for sample in samples], padding='longest',
+                                       truncation=True, return_tensors='pt'),
+            'seq': torch.stack([sample['seq'] for sample in samples])
+        }
+
+
+class LengthBucketSampler(Sampler):
+    """
+        Batch sampler that groups sentences of similar token length, so padding to the longest
+        sentence in a batch stays close to the real token count. Indices are shuffled, cut into
+        buckets of bucket_size batches, sorted by length inside each bucket and the resulting
+        batches are shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, bucket_size=50):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        n = len(self.lengths)
+        indices = torch.randperm(n) if self.shuffle else torch.arange(n)
+
+        batches = []
+        step = self.batch_size * self.bucket_size
+        for start in range(0, n, step):
+            bucket = indices[start:start + step]
+            bucket = bucket[torch.argsort(self.lengths[bucket], stable=True)]
+            batches.extend(bucket.split(self.batch_size))
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            # Only the last bucket can hold an incomplete batch
+            n_full = len(self.lengths) // (self.batch_size * self.bucket_size)
+            rest = len(self.lengths) % (self.batch_size * self.bucket_size)
+            return n_full * self.bucket_size + rest // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
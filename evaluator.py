@@ -1,18 +1,16 @@
 import torch
 from loss import cal_loss
-from metrics import cal_statistic
-from sklearn.metrics import confusion_matrix
+from precision import autocast
+from export import load_compiled, load_onnx
+from quantize import load_quantized
+from metrics import cal_statistic, MetricAccumulator
 from tqdm import tqdm
 import numpy as np
 
 
-def eval(valid_loader, device, model, total_num, args):
-    all_labels = []
-    all_res = []
-    all_pred = []
+def eval(valid_loader, device, model, total_num, args, keep_predictions=False):
+    metrics = MetricAccumulator(device, total_num, keep_predictions)
     model.eval()
-    total_loss = 0
-    total_correct = 0
     with torch.no_grad():
         for batch in tqdm(valid_loader, mininterval=100, desc='- (Validation)  ', leave=False):
             
@@ -23,46 +21,26 @@ def eval(valid_loader, device, model, total_num, args):
             else:
                 text, eeg, label = batch['sentence'].to(device), batch['seq'].to(device), batch['label'].to(device)
             
-            if args.modality == 'text':
-                pred_text = model(text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred_text.max(1)[1].cpu().numpy())
-                all_pred.extend(pred_text.cpu().detach().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred_text)
+            with autocast(args, device):
+                if args.modality == 'text':
+                    pred = model(text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
 
-                total_loss += loss.item()
-                total_correct += n_correct
+                elif args.modality == 'eeg':
+                    pred = model(eeg_src_seq = eeg)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
 
-            elif args.modality == 'eeg':
-                pred_eeg = model(eeg_src_seq = eeg)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred_eeg.max(1)[1].cpu().numpy())
-                all_pred.extend(pred_eeg.cpu().detach().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred_eeg)
-
-                total_loss += loss.item()
-                total_correct += n_correct
-            elif args.modality == 'fusion' and args.model == 'transformer':
-                pred, eeg_embed, text_embed = model(eeg_src_seq = eeg, text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred.max(1)[1].cpu().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred, text_embed = text_embed, eeg_embed = eeg_embed)
-                all_pred.extend(pred.cpu().detach().numpy())
-
-                total_loss += loss.item()
-                total_correct += n_correct
-                
-            elif args.modality == 'fusion' and args.model == 'MLP':
-                pred = model(eeg_src_seq = eeg, text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred.max(1)[1].cpu().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred)
-                all_pred.extend(pred.cpu().detach().numpy())
-
-                total_loss += loss.item()
-                total_correct += n_correct      
-                
-    cm = confusion_matrix(all_labels, all_res)
+                elif args.modality == 'fusion' and args.model in ['transformer', 'bert']:
+                    pred, eeg_embed, text_embed = model(eeg_src_seq = eeg, text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred, text_embed = text_embed, eeg_embed = eeg_embed)
+
+                elif args.modality == 'fusion' and args.model == 'MLP':
+                    pred = model(eeg_src_seq = eeg, text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
+
+            metrics.update(pred.float(), label, loss, n_correct)
+
+    total_loss, total_correct, cm, all_pred, all_labels = metrics.result()
     acc_SP, pre_i, rec_i, F1_i = cal_statistic(cm)
     print('acc_SP is : {acc_SP}'.format(acc_SP=acc_SP))
     print('pre_i is : {pre_i}'.format(pre_i=calculate_average(pre_i)))
@@ -83,13 +61,22 @@ def calculate_average(numbers):
     average = total / len(numbers)
     return average
 
-def inference(test_loader, device, model, total_num, args):
-    all_labels = []
-    all_res = []
-    all_pred = []
+def inference(test_loader, device, model, total_num, args, checkpoint=None):
+    # --onnx / --compiled / --quantized swap in the graph exported from the checkpoint the weights were loaded from.
+    # Weights trained in this run (checkpoint None) have no exported graph yet and always run as is.
+    exported = None
+    if checkpoint is None and (args.onnx == 1 or args.compiled == 1 or args.quantized == 1):
+        print('Evaluating the weights trained in this run, not an exported graph')
+    elif args.onnx == 1:
+        exported = load_onnx(args, device, checkpoint)
+    elif args.compiled == 1:
+        exported = load_compiled(args, device, checkpoint)
+    elif args.quantized == 1:
+        exported = load_quantized(args, device, checkpoint)
+    if exported is not None:
+        model = exported
+    metrics = MetricAccumulator(device, total_num, keep_predictions=True)
     model.eval()
-    total_loss = 0
-    total_correct = 0
     with torch.no_grad():
         for batch in tqdm(test_loader, mininterval=0.5, desc='- (Validation)  ', leave=False):
 
@@ -100,50 +87,28 @@ def inference(test_loader, device, model, total_num, args):
             else:
                 text, eeg, label = batch['sentence'].to(device), batch['seq'].to(device), batch['label'].to(device)
             
-            if args.modality == 'text':
-                pred_text = model(text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred_text.max(1)[1].cpu().numpy())
-                all_pred.extend(pred_text.cpu().detach().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred_text)
+            with autocast(args, device):
+                if args.modality == 'text':
+                    pred = model(text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
 
-                total_loss += loss.item()
-                total_correct += n_correct
+                elif args.modality == 'eeg':
+                    pred = model(eeg_src_seq = eeg)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
 
-            elif args.modality == 'eeg':
-                pred_eeg = model(eeg_src_seq = eeg)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred_eeg.max(1)[1].cpu().numpy())
-                all_pred.extend(pred_eeg.cpu().detach().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred_eeg)
-
-                total_loss += loss.item()
-                total_correct += n_correct
-            elif args.modality == 'fusion' and args.model == 'transformer':
-                pred, eeg_embed, text_embed = model(eeg_src_seq = eeg, text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred.max(1)[1].cpu().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred, eeg_embed = eeg_embed, text_embed = text_embed)
-                all_pred.extend(pred.cpu().detach().numpy())
-
-                total_loss += loss.item()
-                total_correct += n_correct
-                
-            elif args.modality == 'fusion' and args.model == 'MLP':
-                pred = model(eeg_src_seq = eeg, text_src_seq = text)
-                all_labels.extend(label.cpu().numpy())
-                all_res.extend(pred.max(1)[1].cpu().numpy())
-                loss, n_correct = cal_loss(label, args, pred = pred)
-                all_pred.extend(pred.cpu().detach().numpy())
-
-                total_loss += loss.item()
-                total_correct += n_correct      
+                elif args.modality == 'fusion' and args.model in ['transformer', 'bert']:
+                    pred, eeg_embed, text_embed = model(eeg_src_seq = eeg, text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred, text_embed = text_embed, eeg_embed = eeg_embed)
+
+                elif args.modality == 'fusion' and args.model == 'MLP':
+                    pred = model(eeg_src_seq = eeg, text_src_seq = text)
+                    loss, n_correct = cal_loss(label, args, pred = pred)
 
+            metrics.update(pred.float(), label, loss, n_correct)
 
+    total_loss, total_correct, cm, all_pred, all_labels = metrics.result()
     np.savetxt(f'pred_labels/{args.model}_{args.modality}_{args.level}_{args.num_layers}_{args.num_heads}_{args.batch_size}_all_pred.txt',all_pred)
     np.savetxt(f'pred_labels/{args.model}_{args.modality}_{args.level}_{args.num_layers}_{args.num_heads}_{args.batch_size}_all_label.txt', all_labels)
-    all_pred = np.array(all_pred)
-    cm = confusion_matrix(all_labels, all_res)
     print("test_cm:", cm)
     acc_SP, pre_i, rec_i, F1_i = cal_statistic(cm)
     print('acc_SP is : {acc_SP}'.format(acc_SP=acc_SP))
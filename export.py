@@ -0,0 +1,221 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model_new import Transformer, MLP
+from parallel import set_thread_budget
+from config import d_model, d_inner, d_k, d_v, dropout, class_num, EEG_LEN, TEXT_LEN
+
+
+# Graph inputs / outputs per modality, in the order the exported graphs take and return them
+MODALITY_INPUTS = {'text': ['text'], 'eeg': ['eeg'], 'fusion': ['text', 'eeg']}
+MODALITY_OUTPUTS = {'text': ['logits'], 'eeg': ['logits'], 'fusion': ['logits', 'projected_eeg', 'projected_text']}
+
+
+class ModalityGraph(nn.Module):
+    ''' Transformer.forward_<modality> (or the MLP for one modality) as its own module, so it can be traced without the modality dispatch '''
+
+    def __init__(self, model, modality):
+        super().__init__()
+        self.model = model
+        self.modality = modality
+
+    def forward(self, *inputs):
+        if hasattr(self.model, f'forward_{self.modality}'):
+            return getattr(self.model, f'forward_{self.modality}')(*inputs)
+        inputs = dict(zip(MODALITY_INPUTS[self.modality], inputs))
+        return self.model(text_src_seq = inputs.get('text'), eeg_src_seq = inputs.get('eeg'))
+
+
+class CompiledTransformer(nn.Module):
+    ''' Wraps a traced modality graph behind the Transformer.forward(text_src_seq, eeg_src_seq) interface '''
+
+    def __init__(self, graph, modality):
+        super().__init__()
+        self.graph = graph
+        self.modality = modality
+
+    def forward(self, text_src_seq = None, eeg_src_seq = None):
+        if self.modality == 'text':
+            return self.graph(text_src_seq)
+        elif self.modality == 'eeg':
+            return self.graph(eeg_src_seq)
+        else:
+            return self.graph(text_src_seq, eeg_src_seq)
+
+
+def example_inputs(modality, batch_size, device):
+    text = torch.randn(batch_size, TEXT_LEN, device=device)
+    eeg = torch.randn(batch_size, EEG_LEN, device=device)
+    return {'text': (text,), 'eeg': (eeg,), 'fusion': (text, eeg)}[modality]
+
+
+def trace_transformer(model, modality, batch_size=2):
+    """
+        Args: Transformer with trained weights, the modality it was built for
+        Return: frozen TorchScript graph of model.forward_<modality> for inference
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        graph = torch.jit.trace(ModalityGraph(model, modality).eval(), example_inputs(modality, batch_size, device))
+    return torch.jit.freeze(graph)
+
+
+def export_onnx(model, modality, path, batch_size=2):
+    """
+        Args: Transformer or MLP with trained weights, the modality it was built for, output .onnx path
+        Return: (inputs, outputs) of the PyTorch model on random example inputs, for a parity check
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    graph = ModalityGraph(model, modality).eval()
+    inputs = example_inputs(modality, batch_size, device)
+    with torch.no_grad():
+        outputs = graph(*inputs)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        # The MLP returns only the logits, also for fusion
+        output_names = MODALITY_OUTPUTS[modality][:len(outputs)]
+        names = MODALITY_INPUTS[modality] + output_names
+        torch.onnx.export(graph, inputs, path, input_names=MODALITY_INPUTS[modality],
+                          output_names=output_names, dynamic_axes={name: {0: 'batch'} for name in names},
+                          opset_version=17, dynamo=False)
+    return inputs, outputs
+
+
+def check_onnx_parity(path, modality, inputs, outputs, atol=1e-4):
+    ''' Runs the exported graph with onnxruntime and raises if it disagrees with the PyTorch outputs '''
+    from onnx_runner import OnnxModel
+
+    feeds = dict(zip(MODALITY_INPUTS[modality], [x.cpu().numpy() for x in inputs]))
+    onnx_model = OnnxModel(path)
+    onnx_outputs = onnx_model(text_src_seq = feeds.get('text'), eeg_src_seq = feeds.get('eeg'))
+    onnx_outputs = onnx_outputs if isinstance(onnx_outputs, tuple) else (onnx_outputs,)
+    max_diff = max(np.abs(o - t.cpu().numpy()).max() for o, t in zip(onnx_outputs, outputs))
+    if max_diff > atol:
+        raise Exception(f'onnxruntime output of {path} differs from PyTorch by {max_diff:.2e}')
+    return max_diff
+
+
+class OnnxTransformer():
+    ''' onnx_runner.OnnxModel behind the PyTorch model interface of evaluator.inference (torch tensors in and out) '''
+
+    def __init__(self, onnx_model, device):
+        self.onnx_model = onnx_model
+        self.device = device
+
+    def eval(self):
+        return self
+
+    def __call__(self, text_src_seq = None, eeg_src_seq = None):
+        outputs = self.onnx_model(
+            text_src_seq = text_src_seq.cpu().numpy() if text_src_seq is not None else None,
+            eeg_src_seq = eeg_src_seq.cpu().numpy() if eeg_src_seq is not None else None)
+        if isinstance(outputs, tuple):
+            return tuple(torch.from_numpy(output).to(self.device) for output in outputs)
+        return torch.from_numpy(outputs).to(self.device)
+
+
+def compiled_path(checkpoint, modality, extension='ts'):
+    ''' baselines/<checkpoint name>.<modality>.<extension>, written next to the checkpoint it was exported from '''
+    name = os.path.splitext(checkpoint)[0]
+    return os.path.join('baselines', f'{name}.{modality}.{extension}')
+
+
+def load_compiled(args, device, checkpoint):
+    """
+        Args: checkpoint file under baselines/ the weights being evaluated were loaded from
+        Return: CompiledTransformer exported from that checkpoint if export.py has written one that can be used, else None
+    """
+    if args.model != 'transformer' or checkpoint is None:
+        print('--compiled only applies to --model transformer checkpoints, running eagerly')
+        return None
+    if args.precision != 'fp32':
+        print('Compiled graphs are traced in fp32, running eagerly')
+        return None
+    path = compiled_path(checkpoint, args.modality)
+    if not os.path.exists(path):
+        print(f'No compiled graph at {path} (run export.py first), running eagerly')
+        return None
+    try:
+        graph = torch.jit.load(path, map_location=device)
+    except RuntimeError as e:
+        print(f'Could not load {path} ({e}), running eagerly')
+        return None
+    print(f'Using compiled graph {path}')
+    return CompiledTransformer(graph, args.modality)
+
+
+def load_onnx(args, device, checkpoint):
+    """
+        Args: checkpoint file under baselines/ the weights being evaluated were loaded from
+        Return: OnnxTransformer exported from that checkpoint if export.py --export_format onnx has written one, else None
+    """
+    if args.model not in ['transformer', 'MLP'] or checkpoint is None:
+        print('--onnx only applies to --model transformer or MLP checkpoints, running PyTorch')
+        return None
+    path = compiled_path(checkpoint, args.modality, 'onnx')
+    if not os.path.exists(path):
+        print(f'No ONNX graph at {path} (run export.py --export_format onnx first), running PyTorch')
+        return None
+    from onnx_runner import OnnxModel
+
+    print(f'Using onnxruntime with {path}')
+    return OnnxTransformer(OnnxModel(path, args.num_threads), device)
+
+
+def mlp_layer_sizes(state_dict, args):
+    ''' (layer2, layer3, layer4) of a saved fp32 MLP state_dict '''
+    prefix = 'l1_eeg' if args.modality == 'eeg' else 'l1_text'
+    layer2 = state_dict[f'{prefix}.weight'].size(0)
+    layer3 = state_dict[prefix.replace('l1', 'l2') + '.weight'].size(0)
+    layer4 = state_dict[prefix.replace('l1', 'l3') + '.weight'].size(0)
+    return layer2, layer3, layer4
+
+
+def build_model(args, device, layer_sizes=None):
+    ''' Untrained Transformer or MLP (layer_sizes from mlp_layer_sizes) from the main_new.py options, to load saved weights into '''
+    if args.model == 'transformer':
+        return Transformer(device = device, d_feature_text = TEXT_LEN, d_feature_eeg = EEG_LEN,
+                           d_model = d_model, d_inner = d_inner, n_layers = args.num_layers,
+                           n_head = args.num_heads, d_k = d_k, d_v = d_v, dropout = dropout,
+                           class_num = class_num, args = args)
+    elif args.model == 'MLP':
+        return MLP(TEXT_LEN, EEG_LEN, *layer_sizes, class_num, dropout, args)
+    else:
+        raise Exception('Only --model transformer or MLP checkpoints can be exported')
+
+
+def load_checkpoint_model(args, device, checkpoint=None):
+    ''' Transformer or MLP built from the main_new.py options with the weights of baselines/<checkpoint> (default args.checkpoint) '''
+    checkpoint = torch.load(os.path.join('baselines', checkpoint or args.checkpoint), map_location = device)
+    layer_sizes = mlp_layer_sizes(checkpoint['model'], args) if args.model == 'MLP' else None
+    model = build_model(args, device, layer_sizes)
+    model.load_state_dict(checkpoint['model'])
+    return model.to(device)
+
+
+if __name__ == '__main__':
+    from main_new import get_args
+
+    # Same options as main_new.py, e.g.
+    # python export.py --model transformer --modality fusion --checkpoint <name>.chkpt --num_layers 1 --num_heads 1 --export_format onnx
+    args = get_args()
+    set_thread_budget(args)
+    device = torch.device(args.device)
+
+    model = load_checkpoint_model(args, device)
+
+    if args.export_format == 'torchscript':
+        graph = trace_transformer(model, args.modality, args.batch_size)
+        path = compiled_path(args.checkpoint, args.modality)
+        torch.jit.save(graph, path)
+        print(f'Saved {args.modality} graph to {path}')
+    elif args.export_format == 'onnx':
+        path = compiled_path(args.checkpoint, args.modality, 'onnx')
+        inputs, outputs = export_onnx(model, args.modality, path, args.batch_size)
+        max_diff = check_onnx_parity(path, args.modality, inputs, outputs)
+        print(f'Saved {args.modality} ONNX graph to {path} (max |onnxruntime - PyTorch| {max_diff:.2e})')
+    else:
+        raise Exception('export_format can only be one of "torchscript" or "onnx"')
@@ -1,113 +1,228 @@
 import torch
 from config import *
 import torch.nn.functional as F
-from scipy.stats import wasserstein_distance
+from precision import full_precision
 
 # --- Modified version of CCA loss function originally introduced by Galen Andrew et al. (2013) 
 # and re-implemented by https://github.com/Michaelvll/DeepCCA
 
 class cca_loss():
-    def __init__(self, outdim_size, use_all_singular_values, device):
+    def __init__(self, outdim_size, use_all_singular_values, r1=1e-3, r2=1e-3, float64=False,
+                 memory='none', momentum=0.9, queue_size=1024):
         self.outdim_size = outdim_size
         self.use_all_singular_values = use_all_singular_values
-        self.device = device
+        self.r1 = r1
+        self.r2 = r2
+        self.float64 = float64
+        if memory not in ['none', 'ema', 'queue']:
+            raise Exception('cca_memory can only be one of "none", "ema" or "queue"')
+        # ema: exponential averages of the first and second moments of both views
+        # queue: the last queue_size samples of both views
+        self.memory = memory
+        self.momentum = momentum
+        self.queue_size = queue_size
+        self.reset_memory()
+
+    def reset_memory(self):
+        self.moments = None
+        self.queue1, self.queue2 = None, None
+        self.queue_count, self.queue_ptr = 0, 0
+
+    def covariances(self, H1, H2):
+        """
+            Args: H1 (m, o1), H2 (m, o2), m samples of each view
+            Return: SigmaHat11, SigmaHat22, SigmaHat12 of the batch, or with --cca_memory during training, of the batch
+                    and the memory bank. The bank is detached, gradients flow through the batch's share of the estimates only
+        """
+        # Evaluation (grad disabled) neither reads nor moves the bank, so validation losses, which pick checkpoints
+        # and stop training early, come from the validation batches alone
+        if not torch.is_grad_enabled():
+            return self.batch_covariances(H1, H2)
+        if self.memory == 'queue':
+            return self.queue_covariances(H1, H2)
+        elif self.memory == 'ema':
+            return self.ema_covariances(H1, H2)
+        return self.batch_covariances(H1, H2)
+
+    def batch_covariances(self, H1, H2):
+        m = H1.size(0)
+        H1bar = H1 - H1.mean(dim=0, keepdim=True)
+        H2bar = H2 - H2.mean(dim=0, keepdim=True)
+
+        SigmaHat12 = torch.matmul(H1bar.t(), H2bar) / (m - 1)
+        SigmaHat11 = torch.matmul(H1bar.t(), H1bar) / (m - 1)
+        SigmaHat22 = torch.matmul(H2bar.t(), H2bar) / (m - 1)
+        return SigmaHat11, SigmaHat22, SigmaHat12
+
+    def ema_covariances(self, H1, H2):
+        m = H1.size(0)
+        moments = [H1.mean(dim=0), H2.mean(dim=0), torch.matmul(H1.t(), H1) / m,
+                   torch.matmul(H2.t(), H2) / m, torch.matmul(H1.t(), H2) / m]
+        if self.moments is not None and self.moments[0].dtype == H1.dtype:
+            moments = [self.momentum * old + (1 - self.momentum) * new for old, new in zip(self.moments, moments)]
+        self.moments = [moment.detach() for moment in moments]
+
+        mean1, mean2, M11, M22, M12 = moments
+        return M11 - torch.outer(mean1, mean1), M22 - torch.outer(mean2, mean2), M12 - torch.outer(mean1, mean2)
+
+    def queue_covariances(self, H1, H2):
+        if self.queue1 is None or self.queue1.dtype != H1.dtype:
+            self.queue1 = H1.new_zeros(self.queue_size, H1.size(1))
+            self.queue2 = H2.new_zeros(self.queue_size, H2.size(1))
+            self.queue_count, self.queue_ptr = 0, 0
+
+        covariances = self.batch_covariances(torch.cat([H1, self.queue1[:self.queue_count]]),
+                                             torch.cat([H2, self.queue2[:self.queue_count]]))
+
+        # Ring buffer: the newest samples overwrite the oldest
+        index = (self.queue_ptr + torch.arange(min(H1.size(0), self.queue_size), device=H1.device)) % self.queue_size
+        self.queue1[index] = H1[-index.size(0):].detach()
+        self.queue2[index] = H2[-index.size(0):].detach()
+        self.queue_ptr = (self.queue_ptr + index.size(0)) % self.queue_size
+        self.queue_count = min(self.queue_count + index.size(0), self.queue_size)
+        return covariances
+
+    def whitened_cross_covariance(self, SigmaHat11, SigmaHat22, SigmaHat12):
+        """
+            Args: auto- and cross-covariances of the two views
+            Return: L1^-1 SigmaHat12 L2^-T, where L1 L1^T = SigmaHat11 and L2 L2^T = SigmaHat22 (Cholesky).
+                    Same singular values as SigmaHat11^-1/2 SigmaHat12 SigmaHat22^-1/2, without an eigendecomposition
+        """
+        # Regularize in place instead of adding a fresh torch.eye
+        SigmaHat11.diagonal().add_(self.r1)
+        SigmaHat22.diagonal().add_(self.r2)
+
+        L1 = torch.linalg.cholesky(SigmaHat11)
+        L2 = torch.linalg.cholesky(SigmaHat22)
+        Tval = torch.linalg.solve_triangular(L1, SigmaHat12, upper=False)
+        Tval = torch.linalg.solve_triangular(L2, Tval.t(), upper=False).t()
+        return Tval
 
     def loss(self, H1, H2):
         """
         It is the loss function of CCA as introduced in the original paper. There can be other formulations.
+            Args: H1 (m, o1), H2 (m, o2) on any device, m > 1
+            Return: minus the total correlation of the top outdim_size canonical directions (all of them with use_all_singular_values)
         """
+        dtype = H1.dtype
+        if self.float64:
+            H1, H2 = H1.double(), H2.double()
 
-        r1 = 1e-3
-        r2 = 1e-3
-        eps = 1e-9
-
-        H1, H2 = H1.t(), H2.t()
-
-        o1 =  H1.size(0)
-        o2 = H2.size(0)
-
-        m = H1.size(1)
-
-
-
-        H1bar = H1 - H1.mean(dim=1).unsqueeze(dim=1)
-        H2bar = H2 - H2.mean(dim=1).unsqueeze(dim=1)
-
-        SigmaHat12 = (1.0 / (m - 1)) * torch.matmul(H1bar, H2bar.t())
-        SigmaHat11 = (1.0 / (m - 1)) * torch.matmul(H1bar,
-                                                    H1bar.t()) + r1 * torch.eye(o1, device=self.device)
-        SigmaHat22 = (1.0 / (m - 1)) * torch.matmul(H2bar,
-                                                    H2bar.t()) + r2 * torch.eye(o2, device=self.device)
-
-        # Workaround !!! USE BATCH > 16
-        [D1, V1] = torch.symeig(SigmaHat11, eigenvectors=True)
-        [D2, V2] = torch.symeig(SigmaHat22, eigenvectors=True)
-        
-        # Newest way but not debugged
-        # [D1, V1] = torch.linalg.eig(SigmaHat11)
-        # [D2, V2] = torch.linalg.eig(SigmaHat22)
-        
-        # Original
-        # [D1, V1] = torch.eig(SigmaHat11, eigenvectors=True)
-        # [D2, V2] = torch.eig(SigmaHat22, eigenvectors=True)
-
-        D1 = D1.unsqueeze(1)
-        posInd1 = torch.gt(D1[:, 0], eps).nonzero()[:, 0]
-        D1 = D1[posInd1, 0]
-        V1 = V1[:, posInd1]
-        D1 = torch.squeeze(D1)  # Remove extra dimensions from D1
-        # Reshape D1 to 1-dimensional tensor
-        D2 = D2.unsqueeze(1)
-        posInd2 = torch.gt(D2, eps).nonzero()[:, 0]
-        posInd2 = torch.gt(D2[:, 0], eps).nonzero()[:, 0]
-        D2 = D2[posInd2, 0]
-        V2 = V2[:, posInd2]
-        D2 = torch.squeeze(D2)
-        
-        SigmaHat11RootInv = torch.matmul(
-            torch.matmul(V1, torch.diag(D1 ** -0.5)), V1.t())
-        SigmaHat22RootInv = torch.matmul(
-            torch.matmul(V2, torch.diag(D2 ** -0.5)), V2.t())
-
-        Tval = torch.matmul(torch.matmul(SigmaHat11RootInv,
-                                         SigmaHat12), SigmaHat22RootInv)
-
+        # Canonical correlations are the singular values of the whitened cross-covariance
+        singular_values = torch.linalg.svdvals(self.whitened_cross_covariance(*self.covariances(H1, H2)))
 
         if self.use_all_singular_values:
-    
-            tmp = torch.matmul(Tval.t(), Tval)
-            corr = torch.trace(torch.sqrt(tmp))
-  
+            corr = singular_values.sum()
         else:
-   
-            trace_TT = torch.matmul(Tval.t(), Tval)
-            trace_TT = torch.add(trace_TT, (torch.eye(trace_TT.shape[0])*r1).to(self.device)) 
-            U, V = torch.symeig(trace_TT, eigenvectors=True)
-            U = torch.where(U>eps, U, (torch.ones(U.shape).float()*eps).to(self.device))
-            U = U.topk(self.outdim_size)[0]
-            corr = torch.sum(torch.sqrt(U))
-        return -corr
+            # sqrt of the top eigenvalues of Tval^T Tval + r1 I, as in the original formulation
+            k = min(self.outdim_size, singular_values.size(0))
+            corr = torch.sqrt(singular_values[:k].pow(2) + self.r1).sum()
+        return -corr.to(dtype)
+
+
+# One CCA loss (and memory bank) per configuration
+_cca = {}
+
+
+def get_cca(args):
+    key = (args.cca_memory, args.cca_momentum, args.cca_queue_size)
+    if key not in _cca:
+        _cca[key] = cca_loss(outdim_size, use_all_singular_values, float64=cca_float64, memory=args.cca_memory,
+                             momentum=args.cca_momentum, queue_size=args.cca_queue_size)
+    return _cca[key]
+
+
+def wasserstein_1d(u_values, v_values):
+    """
+        Args: 1-D tensors of samples of two empirical distributions (uniform weights, sizes may differ)
+        Return: 1-Wasserstein distance between them, as scipy.stats.wasserstein_distance but differentiable and on device
+    """
+    u_sorted = torch.sort(u_values)[0]
+    v_sorted = torch.sort(v_values)[0]
+    if u_sorted.size(0) == v_sorted.size(0):
+        # Equal sizes: the quantile functions are step functions on the same grid
+        return (u_sorted - v_sorted).abs().mean()
+
+    # Integrate |U - V| over the merged support, U and V the two empirical CDFs
+    all_values = torch.sort(torch.cat([u_sorted, v_sorted]))[0]
+    deltas = all_values[1:] - all_values[:-1]
+    u_cdf = torch.searchsorted(u_sorted.detach(), all_values[:-1].detach(), right=True).to(deltas.dtype) / u_sorted.size(0)
+    v_cdf = torch.searchsorted(v_sorted.detach(), all_values[:-1].detach(), right=True).to(deltas.dtype) / v_sorted.size(0)
+    return ((u_cdf - v_cdf).abs() * deltas).sum()
+
+
+class sliced_wasserstein():
+    def __init__(self, n_projections, seed=0):
+        self.n_projections = n_projections
+        # Own generator, so drawing directions neither depends on nor shifts the global RNG (dropout, shuffling)
+        self.generator = torch.Generator().manual_seed(seed)
+        self.directions = None
+
+    def projection_directions(self, X):
+        """
+            Args: X (m, d)
+            Return: (d, n_projections) unit directions. New ones are drawn for every training step,
+                    evaluation (grad disabled) reuses the last ones so validation losses are comparable across epochs
+        """
+        if torch.is_grad_enabled() or self.directions is None or self.directions.size(0) != X.size(1):
+            directions = torch.randn(X.size(1), self.n_projections, generator=self.generator, dtype=torch.float64)
+            self.directions = directions / directions.norm(dim=0, keepdim=True)
+        return self.directions.to(device=X.device, dtype=X.dtype)
 
-cca = cca_loss(outdim_size, use_all_singular_values, device = device)
+    def loss(self, X, Y):
+        """
+            Args: X (m, d), Y (m, d) samples of two distributions over R^d
+            Return: 1-Wasserstein distance between the projections of X and Y, averaged over the directions
+        """
+        directions = self.projection_directions(X)
+        X_projected = torch.sort(torch.matmul(X, directions), dim=0)[0]
+        Y_projected = torch.sort(torch.matmul(Y, directions), dim=0)[0]
+        return (X_projected - Y_projected).abs().mean()
+
+
+# One sliced Wasserstein loss (and generator) per number of projections
+_sliced_wasserstein = {}
+
+
+def get_sliced_wasserstein(args):
+    if args.wd_projections not in _sliced_wasserstein:
+        _sliced_wasserstein[args.wd_projections] = sliced_wasserstein(args.wd_projections, seed=wd_projection_seed)
+    return _sliced_wasserstein[args.wd_projections]
+
+
+def wasserstein_loss(text_embed, eeg_embed, args):
+    ''' Sliced Wasserstein over the batch with args.wd_projections > 0, else 1-D Wasserstein of the flattened embeddings '''
+    if args.wd_projections > 0:
+        return get_sliced_wasserstein(args).loss(text_embed, eeg_embed)
+    return wasserstein_1d(text_embed.flatten(), eeg_embed.flatten())
 
 
 def cal_loss(label, args, pred=None, text_embed=None, eeg_embed=None):
+    # Losses (incl. the Cholesky solves and SVD of the CCA loss) always run in fp32, also under --precision bf16
+    with full_precision(pred):
+        return _cal_loss(label, args, pred.float(),
+                         text_embed.float() if text_embed is not None else None,
+                         eeg_embed.float() if eeg_embed is not None else None)
+
+
+def _cal_loss(label, args, pred=None, text_embed=None, eeg_embed=None):
     loss = None
     n_correct = None
     
     loss = args.ce_weight * F.cross_entropy(pred, label, reduction='sum')
     pred = pred.max(1)[1]
-    n_correct = pred.eq(label).sum().item()
+    # Stays a tensor on the device, summed by metrics.MetricAccumulator without a per-step sync
+    n_correct = pred.eq(label).sum()
     
     if args.loss == 'CE':
         return loss, n_correct
     elif args.loss == 'CCA' and args.modality == 'fusion':
-        loss = loss + args.cca_weight * cca.loss(text_embed, eeg_embed)
+        loss = loss + args.cca_weight * get_cca(args).loss(text_embed, eeg_embed)
         return loss, n_correct
     elif args.loss == 'WD' and args.modality == 'fusion':
-        loss = loss + args.wd_weight * torch.tensor(wasserstein_distance(text_embed.cpu().detach().numpy().flatten(), eeg_embed.cpu().detach().numpy().flatten()), requires_grad=True)
+        loss = loss + args.wd_weight * wasserstein_loss(text_embed, eeg_embed, args)
         return loss, n_correct
     elif args.loss == 'CCAWD' and args.modality == 'fusion':
-        loss = loss + args.cca_weight * cca.loss(text_embed, eeg_embed)
-        loss = loss + args.wd_weight * torch.tensor(wasserstein_distance(text_embed.cpu().detach().numpy().flatten(), eeg_embed.cpu().detach().numpy().flatten()), requires_grad=True)
+        loss = loss + args.cca_weight * get_cca(args).loss(text_embed, eeg_embed)
+        loss = loss + args.wd_weight * wasserstein_loss(text_embed, eeg_embed, args)
         return loss, n_correct    
\ No newline at end of file
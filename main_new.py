@@ -8,17 +8,17 @@ from torch.optim import Adam
 import json
 from torch.utils.data import DataLoader
 import time
-from transformers import BertModel, BertTokenizer
 
-from config import EEG_LEN, TEXT_LEN, d_model, d_inner, d_k, d_v, class_num, dropout
+from config import EEG_LEN, TEXT_LEN, d_model, d_inner, d_k, d_v, class_num, dropout, PRE_TRAINED_MODEL_NAME
 from optim_new import ScheduledOptim, early_stopping
 from trainer import train
 from evaluator import eval, inference
-from model_new import Transformer
+from model_new import Transformer, BertClassifier
+from parallel import set_thread_budget
 from utils import open_file
 from new_plot import plot_learning_curve
-from dataset_new import prepare_sr_eeg_data, EEGDataset, clean_dic, shuffle_split_data
-torch.set_num_threads(2)
+from dataset_new import prepare_sr_eeg_data, EEGDataset, shuffle_split_data, BertCollator, LengthBucketSampler, seed_worker
+from text_encoder import SentenceEmbeddingStore
 
 def get_args():
     parser = argparse.ArgumentParser(description=None)
@@ -39,21 +39,128 @@ def get_args():
     parser.add_argument('--inference', type = int, default = 0)
     parser.add_argument('--checkpoint', type = str, default = None)
     parser.add_argument('--dev', type = int, default = 0)
+    parser.add_argument('--onnx', type = int, default = 0, help = 'For inference, run the ONNX graph export.py wrote for --checkpoint with onnxruntime (falls back to PyTorch if there is none)')
+    parser.add_argument('--export_format', type = str, default = 'torchscript', help = "For export.py, from ['torchscript', 'onnx']")
+    parser.add_argument('--compiled', type = int, default = 0, help = 'For inference, use the TorchScript graph export.py wrote for --checkpoint (falls back to eager if there is none)')
+    parser.add_argument('--quantized', type = int, default = 0, help = 'For inference, run the int8 model quantize.py wrote for --checkpoint on the cpu (falls back to fp32 if there is none)')
     parser.add_argument('--loss', type = str, default = 'CE', help = "Please choose one of the following loss functions [CE, CCA, WD, CCAWD]")
     parser.add_argument('--num_layers', type = int, default = 1, help = 'Please choose how many layers the encoder should have')
     parser.add_argument('--num_heads', type = int, default = 1, help = 'Please choose how many heads the encoder should have')
     parser.add_argument('--dropout', type= float, default = 0.3, help = 'Please indicate the dropout proportion')
-    parser.add_argument('--text_llm', type=str, default = 'bert', help = 'Please choose which LLM to encode text')
+    parser.add_argument('--text_llm', type=str, default = 'bert', help = "Please choose which LLM to encode text from ['bert', 'seqbert', 'bert-int8']")
     parser.add_argument('--ce_weight', type = float, default = 1, help = 'Please choose the ce loss weight')
     parser.add_argument('--cca_weight', type = float, default = 1, help = 'Please choose the cca loss weight')
+    parser.add_argument('--cca_memory', type = str, default = 'none', help = "Estimate the CCA covariances from ['none', 'ema', 'queue']: the batch only, exponential averages over batches, or the batch plus a queue of recent samples (training only, evaluation uses each batch alone)")
+    parser.add_argument('--cca_momentum', type = float, default = 0.9, help = 'For --cca_memory ema, weight of the running estimates against the current batch')
+    parser.add_argument('--cca_queue_size', type = int, default = 1024, help = 'For --cca_memory queue, number of recent samples kept')
     parser.add_argument('--wd_weight', type = float, default = 1, help = 'Please choose the wd loss weight')
+    parser.add_argument('--wd_projections', type = int, default = 0, help = 'For WD losses, number of random projections of a sliced Wasserstein distance over the batch (0 = 1-D distance of the flattened embeddings)')
+    parser.add_argument('--eeg_tokens', type = str, default = 'scalar', help = "EEG tokens for --model transformer from ['scalar' (832 tokens), 'electrode' (104 tokens of 8 bands), 'band' (8 tokens of 104 electrodes)]")
+    parser.add_argument('--attention', type = str, default = 'dense', help = "Attention inside the encoders from ['dense', 'local', 'linear'] (local and linear avoid the L x L score matrix)")
+    parser.add_argument('--attention_window', type = int, default = 32, help = 'For --attention local, how many positions on each side a query attends to')
+    parser.add_argument('--fused_attention', type = int, default = 0, help = 'Use the copy-free head-batched attention (FusedMultiHeadAttention), loads the same checkpoints')
+    parser.add_argument('--pad_masks', type = int, default = 1, help = 'Mask zero (PAD) positions in the encoders; 0 skips the masks for inputs known to hold no PAD values')
+    parser.add_argument('--checkpoint_layers', type = int, default = 0, help = 'Recompute each encoder layer in backward instead of keeping its attention activations (less memory, slower steps)')
+    parser.add_argument('--precision', type = str, default = 'fp32', help = "Numeric precision of the forward passes and losses from ['fp32', 'bf16'] (bf16 uses autocast; losses, softmax and attention BatchNorm stay fp32)")
+    parser.add_argument('--num_threads', type = int, default = 2, help = 'Number of intra-op threads torch uses for the model')
+    parser.add_argument('--interop_threads', type = int, default = 0, help = 'Number of inter-op threads torch uses, e.g. for the forked branches of a compiled fusion graph (0 = torch default)')
+    parser.add_argument('--fusion_parallel', type = int, default = 0, help = 'For --modality fusion, run the text and EEG encoders concurrently (each branch gets half of --num_threads while they run)')
+    parser.add_argument('--num_workers', type = int, default = 0, help = 'Number of DataLoader worker processes (0 = load batches in the main process)')
+    parser.add_argument('--persistent_workers', type = int, default = 0, help = 'Keep DataLoader workers alive between epochs')
+    parser.add_argument('--prefetch_factor', type = int, default = 2, help = 'Batches prefetched by each DataLoader worker')
+    parser.add_argument('--pin_memory', type = int, default = 0, help = 'Copy batches into pinned memory before moving them to the device')
+    parser.add_argument('--length_bucketing', type = int, default = 0, help = 'For --model bert, batch training sentences of similar token length together')
+    parser.add_argument('--ingest_workers', type = int, default = 0, help = 'Number of processes used to parse the ZuCo .mat files (0 = serial)')
+    parser.add_argument('--eeg_skipna', type = int, default = 0, help = 'Average each EEG value only over the subjects that recorded it instead of treating NaNs as 0')
+    parser.add_argument('--eeg_cache', type = int, default = 1, help = 'Reuse the per-subject EEG cache next to data/SR while the .mat files are unchanged (0 rebuilds it)')
+    parser.add_argument('--eeg_subjects', type = str, default = None, help = 'Comma-separated subjects to average the EEG over, e.g. ZAB,ZDM (default: all)')
+    parser.add_argument('--exclude_subjects', type = str, default = None, help = 'Comma-separated subjects to leave out of the EEG average, e.g. for leave-one-out')
     return parser.parse_args()
 
 
+def get_loader_kwargs(args):
+    kwargs = {
+        'num_workers' : args.num_workers,
+        'pin_memory' : args.pin_memory == 1,
+        'worker_init_fn' : seed_worker
+    }
+    if args.num_workers > 0:
+        kwargs['persistent_workers'] = args.persistent_workers == 1
+        kwargs['prefetch_factor'] = args.prefetch_factor
+    return kwargs
+
+
+def get_zuco_sentence_loaders(args):
+    """
+        Args: parsed arguments (ZuCo, SA task, sentence level)
+        Return: (train_dataset, val_dataset, test_dataset), (train_loader, val_loader, test_loader)
+    """
+    # Load csv
+    sentiment_labels = pd.read_csv('data/sentiment_labels_clean.csv')
+    
+    sr_eeg_data_path = 'data/SR'
+    
+    sentence_list = sentiment_labels.sentence.tolist()
+    labels_list = sentiment_labels.sentiment_label.tolist()
+    sentence_ids_list = sentiment_labels.sentence_id.tolist()
+    
+    eeg_data = prepare_sr_eeg_data(sr_eeg_data_path, sentence_list, labels_list, sentence_ids_list, args)
+    
+    train_idx, val_idx, test_idx = shuffle_split_data(eeg_data)
+    
+    # One store shared by all splits, so the text encoder is loaded at most once
+    store = SentenceEmbeddingStore(args.text_llm)
+    
+    train_dataset = EEGDataset(eeg_data, args, store, train_idx)
+    val_dataset = EEGDataset(eeg_data, args, store, val_idx)
+    test_dataset = EEGDataset(eeg_data, args, store, test_idx)
+                    
+    loader_kwargs = get_loader_kwargs(args)
+    
+    collate_fn = None
+    if args.model == 'bert':
+        collate_fn = BertCollator(train_dataset.tokenizer)
+    
+    if args.model == 'bert' and args.length_bucketing == 1:
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            batch_sampler=LengthBucketSampler(train_dataset.token_lengths(), args.batch_size, shuffle=True, drop_last=True),
+            collate_fn=collate_fn,
+            **loader_kwargs
+        )
+    else:
+        train_loader = DataLoader(
+            dataset=train_dataset,
+            batch_size=args.batch_size,
+            shuffle=True, 
+            drop_last = True,
+            collate_fn=collate_fn,
+            **loader_kwargs
+        )
+    val_loader = DataLoader(
+        dataset=val_dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        collate_fn=collate_fn,
+        **loader_kwargs
+    )
+    test_loader = DataLoader(
+        dataset=test_dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        drop_last = True,
+        collate_fn=collate_fn,
+        **loader_kwargs
+    )
+
+    return (train_dataset, val_dataset, test_dataset), (train_loader, val_loader, test_loader)
+
+
 if __name__ == '__main__':
     
     
     args = get_args()
+    set_thread_budget(args)
     os.environ['TOKENIZERS_PARALLELISM'] = 'false'
     device = torch.device(args.device)
     print(device)
@@ -80,54 +187,20 @@ if __name__ == '__main__':
                 pass      
             
             else:
-                # Load csv
-                sentiment_labels = pd.read_csv('data/sentiment_labels_clean.csv')
-                
-                sr_eeg_data_path = 'data/SR'
-                
-                sentence_list = sentiment_labels.sentence.tolist()
-                labels_list = sentiment_labels.sentiment_label.tolist()
-                sentence_ids_list = sentiment_labels.sentence_id.tolist()
-                
-                eeg_dict = prepare_sr_eeg_data(sr_eeg_data_path, sentence_list, labels_list, sentence_ids_list, args)
-                
-                eeg_train_split, eeg_val_split, eeg_test_split = shuffle_split_data(eeg_dict)
-                
-                train_set, train_id_mapping = clean_dic(eeg_train_split)
-                val_set, val_id_mapping = clean_dic(eeg_val_split)
-                test_set, test_id_mapping = clean_dic(eeg_test_split)
-                
-                
-                train_dataset = EEGDataset(train_set, args)
-                val_dataset = EEGDataset(val_set, args)
-                test_dataset = EEGDataset(test_set,args)
-                                
-                train_loader = DataLoader(
-                    dataset=train_dataset,
-                    batch_size=args.batch_size,
-                    shuffle=True, 
-                    drop_last = True
-                )
-                val_loader = DataLoader(
-                    dataset=val_dataset,
-                    batch_size=args.batch_size,
-                    shuffle=False,
-                )
-                test_loader = DataLoader(
-                    dataset=test_dataset,
-                    batch_size=args.batch_size,
-                    shuffle=False,
-                    drop_last = True
-                )
-                
+                (train_dataset, val_dataset, test_dataset), (train_loader, val_loader, test_loader) = get_zuco_sentence_loaders(args)
+
                 if args.model == 'transformer':
                     model = Transformer(device = device, d_feature_text = TEXT_LEN, d_feature_eeg = EEG_LEN,\
                                             d_model = d_model, d_inner = d_inner, n_layers = args.num_layers, \
                                             n_head=args.num_heads, d_k = d_k, d_v = d_v, dropout= dropout, \
                                             class_num = class_num, args = args)
                 elif args.model == 'bert':
-                    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-                    model = BertModel.from_pretrained("bert-base-uncased")
+                    # Fine-tuned here, so not the shared (frozen) encoder from the text_encoder registry
+                    from transformers import BertModel
+                    model = BertClassifier(bert = BertModel.from_pretrained(PRE_TRAINED_MODEL_NAME), device = device, d_feature_eeg = EEG_LEN,\
+                                            d_model = d_model, d_inner = d_inner, n_layers = args.num_layers, \
+                                            n_head=args.num_heads, d_k = d_k, d_v = d_v, dropout= dropout, \
+                                            class_num = class_num, args = args)
                     
                 model = model.to(device)
                 
@@ -140,7 +213,6 @@ if __name__ == '__main__':
                 )
                 
                 all_train_loss, all_train_acc, all_val_loss, all_val_acc = [], [], [], []
-                all_pred_val, all_label_val = [], []
                 eva_indices = []
                 all_epochs  = []
                 if args.inference == 1:
@@ -149,7 +221,7 @@ if __name__ == '__main__':
                     checkpoint = torch.load(chkpt_path, map_location = 'cuda')
                     model.load_state_dict(checkpoint['model'])
                     model = model.to(device)
-                    inference(test_loader, device, model, test_dataset.__len__(), args)
+                    inference(test_loader, device, model, test_dataset.__len__(), args, checkpoint = args.checkpoint)
                 
                 else:
                     for epoch in range(args.epochs):
@@ -168,8 +240,6 @@ if __name__ == '__main__':
                             'epoch' : epoch
                         }
                     
-                        all_pred_val.extend(val_preds)
-                        all_label_val.extend(val_labels)
                         all_train_loss.append(train_loss)
                         all_train_acc.append(train_acc)
                         all_val_loss.append(val_loss)
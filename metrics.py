@@ -1,5 +1,6 @@
 from config import class_num
 import numpy as np
+import torch
 
 def cal_statistic(cm):
     total_pred = cm.sum(0)
@@ -17,4 +18,56 @@ def cal_statistic(cm):
     rec_i[np.isnan(rec_i)] = 0
     F1_i[np.isnan(F1_i)] = 0
 
-    return acc_SP, list(pre_i), list(rec_i), list(F1_i)
\ No newline at end of file
+    return acc_SP, list(pre_i), list(rec_i), list(F1_i)
+
+class MetricAccumulator():
+    '''
+        Loss sum, correct count and confusion matrix (true x predicted) of an epoch, kept as tensors on the device
+        so a step never waits for the host. result() syncs once, at the end of the epoch. With keep_predictions,
+        the logits and labels are also written to buffers preallocated for total_num samples.
+    '''
+
+    def __init__(self, device, total_num=None, keep_predictions=False, num_classes=class_num):
+        self.num_classes = num_classes
+        self.loss_sum = torch.zeros((), device=device)
+        self.n_correct = torch.zeros((), dtype=torch.long, device=device)
+        self.confusion = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+        self.n_seen = 0
+
+        self.keep_predictions = keep_predictions
+        if keep_predictions:
+            if total_num is None:
+                raise Exception('keep_predictions needs the total number of samples to preallocate for')
+            self.preds = torch.empty(total_num, num_classes, device=device)
+            self.labels = torch.empty(total_num, dtype=torch.long, device=device)
+
+    def update(self, pred, label, loss=None, n_correct=None):
+        """
+            Args: logits (b, num_classes), labels (b,), optionally the batch's loss and n_correct as returned by cal_loss
+        """
+        with torch.no_grad():
+            res = pred.argmax(1)
+            if loss is not None:
+                self.loss_sum += loss.detach().float()
+            self.n_correct += n_correct if n_correct is not None else res.eq(label).sum()
+            self.confusion += torch.bincount(label * self.num_classes + res, minlength=self.num_classes * self.num_classes)
+
+            n = label.size(0)
+            if self.keep_predictions:
+                if self.n_seen + n > self.preds.size(0):
+                    raise Exception(f'More than the {self.preds.size(0)} samples preallocated for were seen')
+                self.preds[self.n_seen:self.n_seen + n] = pred.float()
+                self.labels[self.n_seen:self.n_seen + n] = label
+            self.n_seen += n
+
+    def result(self):
+        """
+            Return: loss sum, number of correct predictions, confusion matrix (num_classes x num_classes numpy array),
+                    predictions and labels (numpy arrays, None without keep_predictions)
+        """
+        cm = self.confusion.view(self.num_classes, self.num_classes).cpu().numpy()
+        preds, labels = None, None
+        if self.keep_predictions:
+            preds = self.preds[:self.n_seen].cpu().numpy()
+            labels = self.labels[:self.n_seen].cpu().numpy()
+        return self.loss_sum.item(), self.n_correct.item(), cm, preds, labels
@@ -1,46 +1,88 @@
 import torch
 import torch.nn as nn
-from block_new import get_sinusoid_encoding_table, get_attn_key_pad_mask, get_non_pad_mask, \
-    get_subsequent_mask, EncoderLayer
+from block_new import get_sinusoid_encoding_table, get_pad_masks, run_layer_stack, EncoderLayer
 from config import PAD, KS, Fea_PLUS
 import torch.nn.functional as F
 from loss import cca_loss
+from parallel import run_branches
 from config import *
 
 
+def eeg_token_shape(eeg_tokens, d_feature):
+    '''
+        Args: eeg_tokens in ['scalar', 'electrode', 'band'], d_feature EEG values per sample
+        Return: (number of tokens, features per token) the EEG encoder attends over
+    '''
+    if eeg_tokens == 'scalar':
+        return d_feature, 1
+    if d_feature != EEG_BANDS * EEG_ELECTRODES:
+        raise Exception(f'eeg_tokens {eeg_tokens} needs {EEG_BANDS} bands x {EEG_ELECTRODES} electrodes, got {d_feature} EEG values')
+    if eeg_tokens == 'electrode':
+        return EEG_ELECTRODES, EEG_BANDS
+    elif eeg_tokens == 'band':
+        return EEG_BANDS, EEG_ELECTRODES
+    else:
+        raise Exception('eeg_tokens can only be one of "scalar", "electrode" or "band"')
+
+
 class EEGEncoder(nn.Module):
     def __init__(
             self,
             d_feature,
             n_layers, n_head, d_k, d_v,
-            d_model, d_inner, dropout):
+            d_model, d_inner, dropout, fused_attention=0,
+            attention='dense', attention_window=32, eeg_tokens='scalar', checkpoint_layers=0, pad_masks=1):
         super().__init__()
 
+        # scalar: every EEG value is a token embedded by a Conv1d over its neighbours,
+        # electrode / band: 104 electrode tokens of 8 band powers / 8 band tokens of 104 electrodes, embedded by a Linear
+        self.eeg_tokens = eeg_tokens
+        d_feature, token_features = eeg_token_shape(eeg_tokens, d_feature)
+
         n_position = d_feature + 1
-        self.src_word_emb = nn.Conv1d(1, d_model, kernel_size=KS, padding=int((KS - 1) / 2))
+        if eeg_tokens == 'scalar':
+            self.src_word_emb = nn.Conv1d(1, d_model, kernel_size=KS, padding=int((KS - 1) / 2))
+        else:
+            self.src_word_emb = nn.Linear(token_features, d_model)
 
         self.position_enc = nn.Embedding.from_pretrained(
             get_sinusoid_encoding_table(n_position, d_model, padding_idx=0),
             freeze=True)
+        # Positions 1..d_feature, broadcast over the batch in forward
+        self.register_buffer('src_pos', torch.arange(1, n_position).unsqueeze(0), persistent=False)
 
         self.eeg_layer_stack = nn.ModuleList([
-            EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout, d_feature)
+            EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout, d_feature, fused_attention,
+                         attention, attention_window)
             for _ in range(n_layers)])
-
-    def forward(self, src_seq, src_pos):
-
-        non_pad_mask = get_non_pad_mask(src_seq)
-        slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=src_seq)
-        enc_output = src_seq.unsqueeze(1)
-        enc_output = self.src_word_emb(enc_output)
-        enc_output = enc_output.transpose(1, 2)
+        self.checkpoint_layers = checkpoint_layers
+        self.pad_masks = pad_masks
+
+    def tokenize(self, src_seq):
+        # b x 832 -> b x 8 x 104 (band) or b x 104 x 8 (electrode)
+        if self.eeg_tokens == 'scalar':
+            return src_seq
+        src_seq = src_seq.view(src_seq.size(0), EEG_BANDS, EEG_ELECTRODES)
+        if self.eeg_tokens == 'electrode':
+            src_seq = src_seq.transpose(1, 2)
+        return src_seq
+
+    def forward(self, src_seq, src_pos=None):
+
+        src_seq = self.tokenize(src_seq)
+        if src_pos is None:
+            src_pos = self.src_pos[:, :src_seq.size(1)]
+        non_pad_mask, slf_attn_mask = get_pad_masks(src_seq, self.pad_masks)
+        if self.eeg_tokens == 'scalar':
+            enc_output = src_seq.unsqueeze(1)
+            enc_output = self.src_word_emb(enc_output)
+            enc_output = enc_output.transpose(1, 2)
+        else:
+            enc_output = self.src_word_emb(src_seq)
         enc_output.add_(self.position_enc(src_pos))
 
-        for enc_layer in self.eeg_layer_stack:
-            enc_output, _ = enc_layer(
-                enc_output,
-                non_pad_mask=non_pad_mask,
-                slf_attn_mask=slf_attn_mask)
+        enc_output = run_layer_stack(self.eeg_layer_stack, enc_output, non_pad_mask, slf_attn_mask,
+                                     self.checkpoint_layers)
         return enc_output,
     
 class TextEncoder(nn.Module):
@@ -48,7 +90,8 @@ class TextEncoder(nn.Module):
             self,
             d_feature,
             n_layers, n_head, d_k, d_v,
-            d_model, d_inner, dropout):
+            d_model, d_inner, dropout, fused_attention=0,
+            attention='dense', attention_window=32, checkpoint_layers=0, pad_masks=1):
         super().__init__()
 
         n_position = d_feature + 1
@@ -57,25 +100,28 @@ class TextEncoder(nn.Module):
         self.position_enc = nn.Embedding.from_pretrained(
             get_sinusoid_encoding_table(n_position, d_model, padding_idx=0),
             freeze=True)
+        # Positions 1..d_feature, broadcast over the batch in forward
+        self.register_buffer('src_pos', torch.arange(1, n_position).unsqueeze(0), persistent=False)
 
         self.text_layer_stack = nn.ModuleList([
-            EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout, d_feature)
+            EncoderLayer(d_model, d_inner, n_head, d_k, d_v, dropout, d_feature, fused_attention,
+                         attention, attention_window)
             for _ in range(n_layers)])
+        self.checkpoint_layers = checkpoint_layers
+        self.pad_masks = pad_masks
 
-    def forward(self, src_seq, src_pos):
+    def forward(self, src_seq, src_pos=None):
 
-        non_pad_mask = get_non_pad_mask(src_seq)
-        slf_attn_mask = get_attn_key_pad_mask(seq_k=src_seq, seq_q=src_seq)
+        if src_pos is None:
+            src_pos = self.src_pos[:, :src_seq.size(1)]
+        non_pad_mask, slf_attn_mask = get_pad_masks(src_seq, self.pad_masks)
         enc_output = src_seq.unsqueeze(1)
         enc_output = self.src_word_emb(enc_output)
         enc_output = enc_output.transpose(1, 2)
         enc_output.add_(self.position_enc(src_pos))
 
-        for enc_layer in self.text_layer_stack:
-            enc_output, _ = enc_layer(
-                enc_output,
-                non_pad_mask=non_pad_mask,
-                slf_attn_mask=slf_attn_mask)
+        enc_output = run_layer_stack(self.text_layer_stack, enc_output, non_pad_mask, slf_attn_mask,
+                                     self.checkpoint_layers)
         return enc_output,
     
 class Transformer(nn.Module):
@@ -86,76 +132,149 @@ class Transformer(nn.Module):
 
         super().__init__()
 
+        # The EEG encoder outputs one position per EEG token
+        d_feature_eeg_tokens = eeg_token_shape(args.eeg_tokens, d_feature_eeg)[0]
+
         if args.modality == 'text':
-            self.text_encoder = TextEncoder(d_feature_text, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout)
+            self.text_encoder = TextEncoder(d_feature_text, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout, args.fused_attention,
+                                            args.attention, args.attention_window, args.checkpoint_layers, args.pad_masks)
             self.linear1_cov_text = nn.Conv1d(d_feature_text, 1, kernel_size=1)
 
         elif args.modality == 'eeg':
-            self.eeg_encoder = EEGEncoder(d_feature_eeg, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout)
-            self.linear1_cov_eeg = nn.Conv1d(d_feature_eeg, 1, kernel_size=1)
+            self.eeg_encoder = EEGEncoder(d_feature_eeg, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout, args.fused_attention,
+                                          args.attention, args.attention_window, args.eeg_tokens, args.checkpoint_layers, args.pad_masks)
+            self.linear1_cov_eeg = nn.Conv1d(d_feature_eeg_tokens, 1, kernel_size=1)
         else:
-            self.text_encoder = TextEncoder(d_feature_text, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout)
-            self.eeg_encoder = EEGEncoder(d_feature_eeg, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout)
-            self.linear1_cov_fusion = nn.Conv1d(d_feature_text + d_feature_eeg, 1, kernel_size = 1)
+            self.text_encoder = TextEncoder(d_feature_text, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout, args.fused_attention,
+                                            args.attention, args.attention_window, args.checkpoint_layers, args.pad_masks)
+            self.eeg_encoder = EEGEncoder(d_feature_eeg, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout, args.fused_attention,
+                                          args.attention, args.attention_window, args.eeg_tokens, args.checkpoint_layers, args.pad_masks)
+            self.linear1_cov_fusion = nn.Conv1d(d_feature_text + d_feature_eeg_tokens, 1, kernel_size = 1)
             self.text_projection = nn.Conv1d(d_feature_text, 1, kernel_size = 1)
-            self.eeg_projection = nn.Conv1d(d_feature_eeg, 1, kernel_size = 1)
+            self.eeg_projection = nn.Conv1d(d_feature_eeg_tokens, 1, kernel_size = 1)
             
             
         self.device = device
         self.args = args
+        self.fusion_parallel = args.fusion_parallel
         self.linear1_linear = nn.Linear(d_model, class_num)
 
     def forward(self, text_src_seq = None, eeg_src_seq = None):
-        
-        if (text_src_seq != None) and (eeg_src_seq == None):
-            b_text, l_text = text_src_seq.size()
-            src_pos_text = torch.LongTensor(
-                [list(range(1, l_text + 1)) for i in range(b_text)]).to(self.device)
-            
-            enc_output_text, *_ = self.text_encoder(text_src_seq, src_pos_text)
-            
-            res_text = self.linear1_cov_text(enc_output_text)
-            res_text = res_text.contiguous().view(res_text.size()[0], -1)
-            res_text = self.linear1_linear(res_text)
-            return res_text
-        
-        elif (eeg_src_seq != None) and (text_src_seq == None):
-            b_eeg, l_eeg = eeg_src_seq.size()
-            src_pos_eeg = torch.LongTensor(
-                [list(range(1, l_eeg + 1)) for i in range(b_eeg)]).to(self.device)
-            
-            enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq, src_pos_eeg)
-            
-            res_eeg = self.linear1_cov_eeg(enc_output_eeg)
-            res_eeg = res_eeg.contiguous().view(res_eeg.size()[0], -1)
-            res_eeg = self.linear1_linear(res_eeg)     
-            return res_eeg   
-        
-        elif (text_src_seq != None) and (eeg_src_seq != None):
-            b_text, l_text = text_src_seq.size()
-            b_eeg, l_eeg = eeg_src_seq.size()
-            
-            src_pos_text = torch.LongTensor(
-            [list(range(1, l_text + 1)) for i in range(b_text)]).to(self.device)
-            src_pos_eeg = torch.LongTensor(
-            [list(range(1, l_eeg + 1)) for i in range(b_eeg)]).to(self.device)
-        
 
-            enc_output_text, *_ = self.text_encoder(text_src_seq, src_pos_text)
-            enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq, src_pos_eeg)   
-            projected_text = self.text_projection(enc_output_text)
-            projected_eeg = self.eeg_projection(enc_output_eeg)
-            
-            concat_enc = torch.cat((enc_output_text, enc_output_eeg), dim = 1)
-            
-            res = self.linear1_cov_fusion(concat_enc)
-            res = res.contiguous().view(res.size()[0], -1)
-            res = self.linear1_linear(res)
-            
-            # FOR CCA
-            projected_text = torch.squeeze(projected_text, dim=1)
-            projected_eeg = torch.squeeze(projected_eeg, dim=1)
-            return res, projected_eeg, projected_text
+        if (text_src_seq is not None) and (eeg_src_seq is None):
+            return self.forward_text(text_src_seq)
+
+        elif (eeg_src_seq is not None) and (text_src_seq is None):
+            return self.forward_eeg(eeg_src_seq)
+
+        elif (text_src_seq is not None) and (eeg_src_seq is not None):
+            return self.forward_fusion(text_src_seq, eeg_src_seq)
+
+    # --- One branch-free forward per modality, so each can be traced into its own graph (export.py)
+
+    def forward_text(self, text_src_seq):
+        enc_output_text, *_ = self.text_encoder(text_src_seq)
+
+        res_text = self.linear1_cov_text(enc_output_text)
+        res_text = res_text.contiguous().view(res_text.size()[0], -1)
+        res_text = self.linear1_linear(res_text)
+        return res_text
+
+    def forward_eeg(self, eeg_src_seq):
+        enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq)
+
+        res_eeg = self.linear1_cov_eeg(enc_output_eeg)
+        res_eeg = res_eeg.contiguous().view(res_eeg.size()[0], -1)
+        res_eeg = self.linear1_linear(res_eeg)
+        return res_eeg
+
+    def forward_fusion(self, text_src_seq, eeg_src_seq):
+        if not self.fusion_parallel or torch.onnx.is_in_onnx_export():
+            enc_output_text, *_ = self.text_encoder(text_src_seq)
+            enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq)
+        elif torch.jit.is_tracing():
+            # The traced graph runs the forked text branch on torch's inter-op pool (--interop_threads)
+            text_future = torch.jit.fork(self.text_encoder, text_src_seq)
+            enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq)
+            enc_output_text, *_ = torch.jit.wait(text_future)
+        else:
+            (enc_output_text, *_), (enc_output_eeg, *_) = run_branches(
+                lambda: self.text_encoder(text_src_seq), lambda: self.eeg_encoder(eeg_src_seq))
+        projected_text = self.text_projection(enc_output_text)
+        projected_eeg = self.eeg_projection(enc_output_eeg)
+
+        concat_enc = torch.cat((enc_output_text, enc_output_eeg), dim = 1)
+
+        res = self.linear1_cov_fusion(concat_enc)
+        res = res.contiguous().view(res.size()[0], -1)
+        res = self.linear1_linear(res)
+
+        # FOR CCA
+        projected_text = torch.squeeze(projected_text, dim=1)
+        projected_eeg = torch.squeeze(projected_eeg, dim=1)
+        return res, projected_eeg, projected_text
+
+
+class BertClassifier(nn.Module):
+    ''' Fine-tuned BERT on the BertCollator batches (input_ids / attention_mask), fused with the EEG encoder of Transformer '''
+    def __init__(
+            self, bert, device, d_feature_eeg, d_model,
+            d_inner, n_layers, n_head, d_k, d_v, dropout, class_num, args):
+
+        super().__init__()
+
+        if args.modality not in ['text', 'fusion']:
+            raise Exception('--model bert needs --modality text or fusion')
+
+        self.bert = bert
+        # [CLS] hidden state -> d_model, the size of the EEG embedding it is aligned with
+        self.text_projection = nn.Linear(bert.config.hidden_size, d_model)
+
+        if args.modality == 'fusion':
+            d_feature_eeg_tokens = eeg_token_shape(args.eeg_tokens, d_feature_eeg)[0]
+            self.eeg_encoder = EEGEncoder(d_feature_eeg, n_layers, n_head, d_k, d_v, d_model, d_inner, dropout, args.fused_attention,
+                                          args.attention, args.attention_window, args.eeg_tokens, args.checkpoint_layers, args.pad_masks)
+            self.eeg_projection = nn.Conv1d(d_feature_eeg_tokens, 1, kernel_size = 1)
+            self.linear1_linear = nn.Linear(2 * d_model, class_num)
+        else:
+            self.linear1_linear = nn.Linear(d_model, class_num)
+
+        self.device = device
+        self.args = args
+        self.fusion_parallel = args.fusion_parallel
+
+    def forward(self, text_src_seq = None, eeg_src_seq = None):
+
+        if (text_src_seq is not None) and (eeg_src_seq is None):
+            return self.linear1_linear(self.forward_text(text_src_seq))
+
+        elif (text_src_seq is not None) and (eeg_src_seq is not None):
+            return self.forward_fusion(text_src_seq, eeg_src_seq)
+
+    def forward_text(self, text_src_seq):
+        """
+            Args: text_src_seq BertCollator output, with input_ids and attention_mask (B, L)
+            Return: projected [CLS] hidden state (B, d_model)
+        """
+        outputs = self.bert(input_ids = text_src_seq['input_ids'], attention_mask = text_src_seq['attention_mask'])
+        return self.text_projection(outputs.last_hidden_state[:, 0])
+
+    def forward_eeg(self, eeg_src_seq):
+        enc_output_eeg, *_ = self.eeg_encoder(eeg_src_seq)
+        return torch.squeeze(self.eeg_projection(enc_output_eeg), dim=1)
+
+    def forward_fusion(self, text_src_seq, eeg_src_seq):
+        if self.fusion_parallel:
+            projected_text, projected_eeg = run_branches(
+                lambda: self.forward_text(text_src_seq), lambda: self.forward_eeg(eeg_src_seq))
+        else:
+            projected_text = self.forward_text(text_src_seq)
+            projected_eeg = self.forward_eeg(eeg_src_seq)
+
+        res = self.linear1_linear(torch.cat((projected_text, projected_eeg), dim = 1))
+
+        # FOR CCA
+        return res, projected_eeg, projected_text
 
 
 class MLP(nn.Module):
@@ -0,0 +1,24 @@
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxModel():
+    '''
+        A Transformer or MLP exported by export.py --export_format onnx, run with onnxruntime's CPU execution provider.
+        Called like the PyTorch model (text_src_seq / eeg_src_seq) but takes and returns NumPy arrays, so
+        deployment needs neither PyTorch nor transformers.
+    '''
+
+    def __init__(self, path, num_threads=None):
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def __call__(self, text_src_seq = None, eeg_src_seq = None):
+        inputs = {'text': text_src_seq, 'eeg': eeg_src_seq}
+        outputs = self.session.run(None, {name: np.asarray(inputs[name], dtype=np.float32) for name in self.input_names})
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(outputs)
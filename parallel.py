@@ -0,0 +1,67 @@
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+# Runs the text branch of a fusion forward while the calling thread runs the EEG branch
+_executor = None
+
+
+def set_thread_budget(args):
+    """
+        Args: args.num_threads, args.interop_threads
+        Sets torch's intra-op and inter-op thread pools. run_branches splits the intra-op threads between
+        the two fusion branches only while they run, so the rest of a step keeps all args.num_threads
+    """
+    if args.interop_threads > 0:
+        # Has to happen before any inter-op work (e.g. a forked branch of a compiled graph) starts
+        torch.set_num_interop_threads(args.interop_threads)
+    torch.set_num_threads(args.num_threads)
+
+
+def _autocast_state():
+    return [(device_type, torch.get_autocast_dtype(device_type))
+            for device_type in ['cpu', 'cuda'] if torch.is_autocast_enabled(device_type)]
+
+
+def run_branches(first, second):
+    """
+        Args: two independent callables without arguments
+        Return: (first(), second()), first running on a worker thread while the calling thread runs second.
+                Grad mode, inference mode and autocast are thread-local in torch, so the worker takes over the caller's
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fusion_branch')
+
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    autocast_state = _autocast_state()
+    # Both branches run their ops at the same time, so each gets half of the intra-op threads while they do.
+    # The count is per thread once a thread has run an op, so each side sets and restores its own
+    num_threads = torch.get_num_threads()
+    branch_threads = max(1, num_threads // 2)
+
+    def run_first():
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(inference_mode))
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            for device_type, dtype in autocast_state:
+                stack.enter_context(torch.autocast(device_type=device_type, dtype=dtype))
+            torch.set_num_threads(branch_threads)
+            try:
+                return first()
+            finally:
+                torch.set_num_threads(num_threads)
+
+    torch.set_num_threads(branch_threads)
+    try:
+        future = _executor.submit(run_first)
+        try:
+            second_result = second()
+        finally:
+            # Never leave the worker running on the model when the calling branch fails
+            first_result = future.result()
+    finally:
+        torch.set_num_threads(num_threads)
+    return first_result, second_result
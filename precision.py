@@ -0,0 +1,20 @@
+import contextlib
+import torch
+
+
+def autocast(args, device):
+    """
+        Args: args.precision in ['fp32', 'bf16'], device the model runs on
+        Return: context manager running the enclosed forward pass and loss under bfloat16 autocast (no-op for fp32)
+    """
+    if args.precision == 'fp32':
+        return contextlib.nullcontext()
+    elif args.precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    else:
+        raise Exception('precision can only be one of "fp32" or "bf16"')
+
+
+def full_precision(tensor):
+    ''' Context manager turning autocast off on tensor's device, for ops that must stay in fp32 '''
+    return torch.autocast(device_type=tensor.device.type, enabled=False)
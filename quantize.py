@@ -0,0 +1,133 @@
+import os
+import copy
+import time
+import torch
+import torch.nn as nn
+
+from export import build_model, load_checkpoint_model, mlp_layer_sizes
+from metrics import MetricAccumulator
+from parallel import set_thread_budget
+
+
+def quantize_model(model):
+    """
+        Args: trained Transformer or MLP (fp32, cpu)
+        Return: copy with every nn.Linear dynamically quantized to int8 (weights int8, activations quantized per batch)
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(checkpoint):
+    ''' baselines/<checkpoint name>.int8.chkpt, next to the checkpoint it was quantized from '''
+    name = os.path.splitext(checkpoint)[0]
+    return os.path.join('baselines', f'{name}.int8.chkpt')
+
+
+def load_quantized_model(args, checkpoint):
+    """
+        Args: checkpoint file under baselines/ the int8 model was quantized from
+        Return: the int8 model quantize.py saved for it, on cpu (dynamic quantization runs on cpu only).
+                Only the int8 file is read: its weights are loaded into a quantized skeleton of an untrained model
+    """
+    saved = torch.load(quantized_path(checkpoint), map_location = 'cpu')
+    model = quantize_model(build_model(args, torch.device('cpu'), saved['layer_sizes']))
+    model.load_state_dict(saved['model'])
+    return model
+
+
+class QuantizedTransformer():
+    ''' An int8 model behind the interface of evaluator.inference: inputs moved to the cpu, outputs back to device '''
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def __call__(self, text_src_seq = None, eeg_src_seq = None):
+        outputs = self.model(
+            text_src_seq = text_src_seq.cpu() if text_src_seq is not None else None,
+            eeg_src_seq = eeg_src_seq.cpu() if eeg_src_seq is not None else None)
+        if isinstance(outputs, tuple):
+            return tuple(output.to(self.device) for output in outputs)
+        return outputs.to(self.device)
+
+
+def load_quantized(args, device, checkpoint):
+    """
+        Args: checkpoint file under baselines/ the weights being evaluated were loaded from
+        Return: QuantizedTransformer for that checkpoint if quantize.py has written one that can be used, else None
+    """
+    if args.model not in ['transformer', 'MLP'] or checkpoint is None:
+        print('--quantized only applies to --model transformer or MLP checkpoints, running fp32')
+        return None
+    if args.precision != 'fp32':
+        print('int8 models run without autocast, running fp32')
+        return None
+    path = quantized_path(checkpoint)
+    if not os.path.exists(path):
+        print(f'No int8 model at {path} (run quantize.py first), running fp32')
+        return None
+    print(f'Using int8 model {path}')
+    return QuantizedTransformer(load_quantized_model(args, checkpoint), device)
+
+
+def test_accuracy_latency(model, test_loader, args):
+    """
+        Args: model, test loader of main_new.get_zuco_sentence_loaders
+        Return: accuracy and mean forward seconds per batch on the test split
+    """
+    def forward(batch):
+        if args.modality == 'text':
+            return model(text_src_seq = batch['sentence'])
+        elif args.modality == 'eeg':
+            return model(eeg_src_seq = batch['seq'])
+        else:
+            return model(text_src_seq = batch['sentence'], eeg_src_seq = batch['seq'])
+
+    model.eval()
+    metrics = MetricAccumulator(torch.device('cpu'))
+    seconds = 0.0
+    with torch.no_grad():
+        forward(next(iter(test_loader)))  # untimed warm-up
+        for batch in test_loader:
+            label = batch['label']
+            start = time.time()
+            pred = forward(batch)
+            seconds += time.time() - start
+            if isinstance(pred, tuple):
+                pred = pred[0]
+            metrics.update(pred, label)
+    _, n_correct, _, _, _ = metrics.result()
+    return n_correct / metrics.n_seen, seconds / len(test_loader)
+
+
+if __name__ == '__main__':
+    from main_new import get_args, get_zuco_sentence_loaders
+
+    # Same options as main_new.py, e.g.
+    # python quantize.py --dataset ZuCo --model transformer --modality eeg --checkpoint <name>.chkpt --num_layers 1 --num_heads 1
+    args = get_args()
+    set_thread_budget(args)
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+
+    _, (_, _, test_loader) = get_zuco_sentence_loaders(args)
+
+    model = load_checkpoint_model(args, torch.device('cpu'))
+    quantized = quantize_model(model)
+    torch.save({
+        'model' : quantized.state_dict(),
+        'layer_sizes' : mlp_layer_sizes(model.state_dict(), args) if args.model == 'MLP' else None,
+        'config_file' : 'config',
+        'quantization' : 'dynamic int8 nn.Linear'
+    }, quantized_path(args.checkpoint))
+    print(f'Saved int8 model to {quantized_path(args.checkpoint)}')
+
+    fp32_acc, fp32_latency = test_accuracy_latency(model, test_loader, args)
+    int8_acc, int8_latency = test_accuracy_latency(quantized, test_loader, args)
+    print(f'fp32: test_acc {fp32_acc:.4f}, {fp32_latency * 1000:.2f} ms per batch')
+    print(f'int8: test_acc {int8_acc:.4f}, {int8_latency * 1000:.2f} ms per batch')
+    print(f'delta: test_acc {int8_acc - fp32_acc:+.4f}, latency {int8_latency / fp32_latency:.2f}x')
@@ -2,11 +2,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from precision import full_precision
+
+
+def softmax_dim0(x):
+    # Softmax(dim=0) spelled out with reductions: onnxruntime's Softmax is very slow over a short leading axis
+    x = torch.exp(x - x.amax(dim=0, keepdim=True))
+    return x / x.sum(dim=0, keepdim=True)
 
 class MultiHeadAttention(nn.Module):
     ''' Multi-Head Attention module '''
 
-    def __init__(self, n_head, d_model, d_k, d_v, dropout, d_feature):
+    def __init__(self, n_head, d_model, d_k, d_v, dropout, d_feature, attention='dense', attention_window=32):
         super().__init__()
 
         self.n_head = n_head
@@ -20,7 +27,7 @@ class MultiHeadAttention(nn.Module):
         nn.init.normal_(self.w_ks.weight, mean=0, std=np.sqrt(2.0 / (d_model + d_k)))
         nn.init.normal_(self.w_vs.weight, mean=0, std=np.sqrt(2.0 / (d_model + d_v)))
 
-        self.attention = SDPAttention(temperature=np.power(d_k, 0.5), d_feature = d_feature)
+        self.attention = build_attention(attention, np.power(d_k, 0.5), d_feature, attention_window)
         self.layer_norm = nn.LayerNorm(d_model)
 
         self.fc = nn.Linear(n_head * d_v, d_model)
@@ -45,8 +52,7 @@ class MultiHeadAttention(nn.Module):
         k = k.permute(2, 0, 1, 3).contiguous().view(-1, len_k, d_k)  # (n*b) x lk x dk
         v = v.permute(2, 0, 1, 3).contiguous().view(-1, len_v, d_v)  # (n*b) x lv x dv
 
-        mask = mask.repeat(n_head, 1, 1)  
-        output, attn = self.attention(q, k, v, mask=mask)
+        output, attn = self.attention(q, k, v, mask=mask)  # mask: b x 1 x lk, shared by all heads
 
 
         output = output.view(n_head, sz_b, len_q, d_v)
@@ -59,6 +65,110 @@ class MultiHeadAttention(nn.Module):
         return output, attn
     
 
+class FusedMultiHeadAttention(nn.Module):
+    '''
+        Multi-Head Attention computed in a head-batched layout, numerically equivalent to MultiHeadAttention.
+        q/k/v come out of one batched projection already laid out as n x (b*l) x (2*dk+dv), so the heads
+        are strided views of it instead of permute().contiguous() copies, and fc is applied per head and
+        summed over heads instead of permuting the output back to b x lq x (n*dv).
+        Checkpoints of MultiHeadAttention load into it unchanged.
+    '''
+
+    def __init__(self, n_head, d_model, d_k, d_v, dropout, d_feature, attention='dense', attention_window=32):
+        super().__init__()
+
+        self.n_head = n_head
+        self.d_k = d_k
+        self.d_v = d_v
+        self.d_model = d_model
+
+        # Same layers and initialisation as MultiHeadAttention, then packed into the fused layout
+        w_qs = nn.Linear(d_model, n_head * d_k)
+        w_ks = nn.Linear(d_model, n_head * d_k)
+        w_vs = nn.Linear(d_model, n_head * d_v)
+        nn.init.normal_(w_qs.weight, mean=0, std=np.sqrt(2.0 / (d_model + d_k)))
+        nn.init.normal_(w_ks.weight, mean=0, std=np.sqrt(2.0 / (d_model + d_k)))
+        nn.init.normal_(w_vs.weight, mean=0, std=np.sqrt(2.0 / (d_model + d_v)))
+
+        self.attention = build_attention(attention, np.power(d_k, 0.5), d_feature, attention_window)
+        self.layer_norm = nn.LayerNorm(d_model)
+
+        fc = nn.Linear(n_head * d_v, d_model)
+        nn.init.xavier_normal_(fc.weight)
+
+        self.dropout = nn.Dropout(dropout)
+
+        self.w_qkv = nn.Parameter(torch.empty(n_head, d_model, 2 * d_k + d_v))  # n x d_model x (2*dk+dv)
+        self.b_qkv = nn.Parameter(torch.empty(n_head, 1, 2 * d_k + d_v))
+        self.w_fc = nn.Parameter(torch.empty(n_head, d_v, d_model))  # n x dv x d_model
+        self.b_fc = nn.Parameter(torch.empty(d_model))
+        with torch.no_grad():
+            for name, value in self.fuse_state_dict({
+                    'w_qs.weight': w_qs.weight, 'w_qs.bias': w_qs.bias,
+                    'w_ks.weight': w_ks.weight, 'w_ks.bias': w_ks.bias,
+                    'w_vs.weight': w_vs.weight, 'w_vs.bias': w_vs.bias,
+                    'fc.weight': fc.weight, 'fc.bias': fc.bias}).items():
+                getattr(self, name).copy_(value)
+
+    def fuse_state_dict(self, state_dict, prefix=''):
+        '''
+            Args: MultiHeadAttention parameters (w_qs, w_ks, w_vs, fc) under prefix
+            Return: dict of the equivalent w_qkv, b_qkv, w_fc, b_fc
+        '''
+        n_head, d_model = self.n_head, self.d_model
+        names = ['w_qs', 'w_ks', 'w_vs']
+        weights = [state_dict[prefix + name + '.weight'].view(n_head, -1, d_model) for name in names]
+        biases = [state_dict[prefix + name + '.bias'].view(n_head, 1, -1) for name in names]
+        return {
+            'w_qkv': torch.cat(weights, dim=1).transpose(1, 2).contiguous(),
+            'b_qkv': torch.cat(biases, dim=2),
+            'w_fc': state_dict[prefix + 'fc.weight'].view(d_model, n_head, self.d_v).permute(1, 2, 0).contiguous(),
+            'b_fc': state_dict[prefix + 'fc.bias'],
+        }
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Accept MultiHeadAttention checkpoints
+        if prefix + 'w_qs.weight' in state_dict:
+            fused = self.fuse_state_dict(state_dict, prefix)
+            for name in ['w_qs', 'w_ks', 'w_vs', 'fc']:
+                del state_dict[prefix + name + '.weight'], state_dict[prefix + name + '.bias']
+            for name, value in fused.items():
+                state_dict[prefix + name] = value
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project(self, x, weight, bias):
+        # b x l x d_model -> n x (b*l) x d, one batched matmul shared by all heads (x is broadcast, not copied)
+        x = x.reshape(1, -1, self.d_model).expand(self.n_head, -1, -1)
+        return torch.baddbmm(bias, x, weight)
+
+    def forward(self, q, k, v, mask=None):
+        d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
+
+        sz_b, len_q, _ = q.size()
+        sz_b, len_k, _ = k.size()
+        sz_b, len_v, _ = v.size()
+
+        residual = q
+
+        if q is k and k is v:
+            qkv = self.project(q, self.w_qkv, self.b_qkv).view(-1, len_q, 2 * d_k + d_v)  # (n*b) x l x (2*dk+dv)
+            q, k, v = qkv[..., :d_k], qkv[..., d_k:2 * d_k], qkv[..., 2 * d_k:]
+        else:
+            q = self.project(q, self.w_qkv[..., :d_k], self.b_qkv[..., :d_k]).view(-1, len_q, d_k)
+            k = self.project(k, self.w_qkv[..., d_k:2 * d_k], self.b_qkv[..., d_k:2 * d_k]).view(-1, len_k, d_k)
+            v = self.project(v, self.w_qkv[..., 2 * d_k:], self.b_qkv[..., 2 * d_k:]).view(-1, len_v, d_v)
+
+        output, attn = self.attention(q, k, v, mask=mask)  # mask: b x 1 x lk, shared by all heads
+
+        output = torch.bmm(output.view(n_head, -1, d_v), self.w_fc)  # n x (b*lq) x d_model
+        output = output.sum(dim=0).view(sz_b, len_q, -1) + self.b_fc
+
+        output = self.dropout(output)
+        output = self.layer_norm(output + residual)
+
+        return output, attn
+
+
 # class MultiHeadAttention2(nn.Module):
 #     ''' Multi-Head Attention module '''
 
@@ -192,15 +302,121 @@ class SDPAttention(nn.Module):
 
         if mask is not None:
 
-            attn = attn.masked_fill(mask, 0)
+            # (n*b) x lq x lk viewed as n x b x lq x lk, so the b x 1 x lk mask broadcasts over heads and queries
+            len_q, len_k = attn.size(1), attn.size(2)
+            attn = attn.view(-1, mask.size(0), len_q, len_k).masked_fill(mask, 0).view(-1, len_q, len_k)
 
-        attn = self.BN(attn)
-        attn = self.softmax(attn)
+        with full_precision(attn):  # BatchNorm and softmax stay fp32 under --precision bf16
+            attn = self.BN(attn.float())
+            attn = softmax_dim0(attn) if torch.onnx.is_in_onnx_export() else self.softmax(attn)
         attn = self.dropout(attn)
         output = torch.bmm(attn, v)
 
         return output, attn
 
+class LocalSDPAttention(nn.Module):
+    '''
+        Scaled Dot-Product Attention restricted to the keys within attention_window positions of each query.
+        Queries are processed in blocks of attention_window against the 3 * attention_window keys around them,
+        so the scores take (n*b) x l x (3*window) memory instead of (n*b) x l x l.
+        Masking, BatchNorm and Softmax(dim=0) follow SDPAttention; keys outside the window contribute nothing.
+    '''
+
+    def __init__(self, temperature, d_feature, attention_window, attn_dropout=0.1):
+        super().__init__()
+        self.temperature = temperature
+        self.window = attention_window
+        self.dropout = nn.Dropout(attn_dropout)
+
+        self.softmax = nn.Softmax(dim=0)
+
+        self.BN = nn.BatchNorm1d(d_feature)
+
+    def blocks(self, x, n_blocks, w):
+        # N x l x d -> N x n_blocks x (3*w) x d, block i holding positions (i-1)*w .. (i+2)*w - 1 (zero outside 0..l-1)
+        x = F.pad(x, (0, 0, w, n_blocks * w - x.size(1) + w))
+        shifted = [x[:, shift * w:(shift + n_blocks) * w].reshape(x.size(0), n_blocks, w, x.size(2)) for shift in range(3)]
+        return torch.cat(shifted, dim=2)
+
+    def outside_window(self, length, n_blocks, w, device):
+        # (n_blocks*w) x (3*w), True where the key is further than w from the query or outside the sequence
+        row = torch.arange(w, device=device).view(1, w, 1)
+        col = torch.arange(3 * w, device=device).view(1, 1, 3 * w)
+        key = torch.arange(n_blocks, device=device).view(n_blocks, 1, 1) * w - w + col
+        outside = (col < row) | (col > row + 2 * w) | (key < 0) | (key >= length)
+        return outside.view(n_blocks * w, 3 * w)
+
+    def forward(self, q, k, v, mask=None):
+        sz, len_q, d_k = q.size()
+        w = min(self.window, len_q)  # a window past the sequence end covers everything already
+        n_blocks = -(-len_q // w)
+
+        q = F.pad(q, (0, 0, 0, n_blocks * w - len_q)).view(sz, n_blocks, w, d_k)
+        attn = torch.matmul(q, self.blocks(k, n_blocks, w).transpose(2, 3))  # (n*b) x n_blocks x w x 3w
+
+        attn = attn / self.temperature
+
+
+        if mask is not None:
+
+            # b x 1 x lk -> b x n_blocks x 1 x 3w, broadcast over heads and queries
+            key_mask = self.blocks(mask.transpose(1, 2).float(), n_blocks, w).transpose(2, 3) > 0
+            attn = attn.view(-1, mask.size(0), n_blocks, w, 3 * w).masked_fill(key_mask, 0)
+
+        outside = self.outside_window(len_q, n_blocks, w, attn.device)[:len_q]
+        attn = attn.reshape(sz, n_blocks * w, 3 * w)[:, :len_q].masked_fill(outside, 0)
+
+        with full_precision(attn):  # BatchNorm and softmax stay fp32 under --precision bf16
+            attn = self.BN(attn.float())
+            attn = softmax_dim0(attn) if torch.onnx.is_in_onnx_export() else self.softmax(attn)
+        attn = self.dropout(attn)
+        attn = attn.masked_fill(outside, 0)
+
+        attn_blocks = F.pad(attn, (0, 0, 0, n_blocks * w - len_q)).view(sz, n_blocks, w, 3 * w)
+        output = torch.matmul(attn_blocks, self.blocks(v, n_blocks, w))  # (n*b) x n_blocks x w x dv
+        output = output.view(sz, n_blocks * w, -1)[:, :len_q].contiguous()
+
+        return output, attn
+
+
+class LinearSDPAttention(nn.Module):
+    '''
+        Kernelized linear attention: phi(q) (phi(k)^T v) normalised over the keys, with phi = elu + 1,
+        so no l x l matrix is formed and cost grows linearly with l. Padded keys are dropped.
+        This replaces the BatchNorm and Softmax(dim=0) of SDPAttention, so it is a different model, not an approximation of one checkpoint.
+    '''
+
+    def __init__(self, temperature, eps=1e-6):
+        super().__init__()
+        self.temperature = temperature
+        self.eps = eps
+
+    def forward(self, q, k, v, mask=None):
+        q = F.elu(q / np.sqrt(self.temperature)) + 1
+        k = F.elu(k / np.sqrt(self.temperature)) + 1
+
+        if mask is not None:
+
+            # b x 1 x lk -> b x lk x 1, broadcast over heads and features
+            k = k.view(-1, mask.size(0), k.size(1), k.size(2)).masked_fill(mask.transpose(1, 2), 0).view(k.size())
+
+        kv = torch.bmm(k.transpose(1, 2), v)  # (n*b) x dk x dv
+        normalizer = torch.bmm(q, k.sum(dim=1).unsqueeze(2)) + self.eps  # (n*b) x lq x 1
+        output = torch.bmm(q, kv) / normalizer
+
+        return output, None
+
+
+def build_attention(attention, temperature, d_feature, attention_window):
+    if attention == 'dense':
+        return SDPAttention(temperature=temperature, d_feature=d_feature)
+    elif attention == 'local':
+        return LocalSDPAttention(temperature, d_feature, attention_window)
+    elif attention == 'linear':
+        return LinearSDPAttention(temperature)
+    else:
+        raise Exception('attention can only be one of "dense", "local" or "linear"')
+
 # class SDPAttention2(nn.Module):
 #     ''' Scaled Dot-Product Attention '''
 
@@ -0,0 +1,111 @@
+import unittest
+import torch
+
+from loss import cca_loss, sliced_wasserstein
+
+
+def reference_cca_loss(H1, H2, outdim_size, use_all_singular_values=False, r1=1e-3, r2=1e-3, eps=1e-9):
+    ''' The previous symeig-based CCA loss, with torch.linalg.eigh in place of the removed torch.symeig '''
+    H1, H2 = H1.t(), H2.t()
+    m = H1.size(1)
+    H1bar = H1 - H1.mean(dim=1).unsqueeze(dim=1)
+    H2bar = H2 - H2.mean(dim=1).unsqueeze(dim=1)
+    SigmaHat12 = (1.0 / (m - 1)) * torch.matmul(H1bar, H2bar.t())
+    SigmaHat11 = (1.0 / (m - 1)) * torch.matmul(H1bar, H1bar.t()) + r1 * torch.eye(H1.size(0), device=H1.device, dtype=H1.dtype)
+    SigmaHat22 = (1.0 / (m - 1)) * torch.matmul(H2bar, H2bar.t()) + r2 * torch.eye(H2.size(0), device=H2.device, dtype=H2.dtype)
+
+    def root_inv(sigma):
+        D, V = torch.linalg.eigh(sigma)
+        posInd = torch.gt(D, eps).nonzero()[:, 0]
+        D, V = D[posInd], V[:, posInd]
+        return torch.matmul(torch.matmul(V, torch.diag(D ** -0.5)), V.t())
+
+    Tval = torch.matmul(torch.matmul(root_inv(SigmaHat11), SigmaHat12), root_inv(SigmaHat22))
+    if use_all_singular_values:
+        # Sum of all canonical correlations, the square roots of the eigenvalues of Tval^T Tval
+        U = torch.linalg.eigvalsh(torch.matmul(Tval.t(), Tval))
+        return -torch.sum(torch.sqrt(U.clamp(min=0)))
+    trace_TT = torch.matmul(Tval.t(), Tval) + torch.eye(Tval.size(1), device=H1.device, dtype=H1.dtype) * r1
+    U = torch.linalg.eigvalsh(trace_TT)
+    U = torch.where(U > eps, U, torch.full_like(U, eps))
+    return -torch.sum(torch.sqrt(U.topk(outdim_size)[0]))
+
+
+def correlated_views(batch_size, dim, seed, dtype=torch.float64):
+    ''' Two (batch_size, dim) views sharing a signal, so the canonical correlations are well away from 0 '''
+    generator = torch.Generator().manual_seed(seed)
+    shared = torch.randn(batch_size, dim, generator=generator, dtype=dtype)
+    H1 = shared + torch.randn(batch_size, dim, generator=generator, dtype=dtype)
+    H2 = shared + torch.randn(batch_size, dim, generator=generator, dtype=dtype)
+    return H1, H2
+
+
+class CCALossTest(unittest.TestCase):
+
+    def test_gradcheck(self):
+        H1, H2 = correlated_views(12, 4, seed=0)
+        H1.requires_grad_()
+        H2.requires_grad_()
+        for use_all_singular_values in [False, True]:
+            with self.subTest(use_all_singular_values=use_all_singular_values):
+                cca = cca_loss(2, use_all_singular_values)
+                self.assertTrue(torch.autograd.gradcheck(cca.loss, (H1, H2)))
+
+    def test_matches_eigh_reference(self):
+        for use_all_singular_values in [False, True]:
+            for batch_size in [32, 128]:
+                with self.subTest(use_all_singular_values=use_all_singular_values, batch_size=batch_size):
+                    H1, H2 = correlated_views(batch_size, 8, seed=batch_size)
+                    loss = cca_loss(4, use_all_singular_values).loss(H1, H2)
+                    reference = reference_cca_loss(H1, H2, 4, use_all_singular_values)
+                    torch.testing.assert_close(loss, reference, rtol=1e-9, atol=1e-9)
+
+    def test_small_batches(self):
+        # Fewer samples than the 16 embedding dimensions: the covariances are rank deficient until regularized
+        for use_all_singular_values in [False, True]:
+            for batch_size in [2, 4, 8, 15]:
+                with self.subTest(use_all_singular_values=use_all_singular_values, batch_size=batch_size):
+                    H1, H2 = correlated_views(batch_size, 16, seed=batch_size)
+                    H1.requires_grad_()
+                    H2.requires_grad_()
+                    loss = cca_loss(4, use_all_singular_values).loss(H1, H2)
+                    loss.backward()
+                    self.assertTrue(torch.isfinite(loss))
+                    self.assertTrue(torch.isfinite(H1.grad).all() and torch.isfinite(H2.grad).all())
+                    reference = reference_cca_loss(H1.detach(), H2.detach(), 4, use_all_singular_values)
+                    torch.testing.assert_close(loss.detach(), reference, rtol=1e-6, atol=1e-6)
+
+    def test_float32_close_to_float64(self):
+        H1, H2 = correlated_views(64, 16, seed=1)
+        loss = cca_loss(4, False).loss(H1.float(), H2.float())
+        self.assertEqual(loss.dtype, torch.float32)
+        torch.testing.assert_close(loss.double(), reference_cca_loss(H1, H2, 4), rtol=1e-4, atol=1e-4)
+
+
+class SlicedWassersteinTest(unittest.TestCase):
+
+    def test_evaluation_reuses_directions(self):
+        wd = sliced_wasserstein(8, seed=0)
+        X, Y = correlated_views(32, 4, seed=0)
+        with torch.no_grad():
+            first = wd.loss(X, Y)
+            self.assertEqual(wd.loss(X, Y), first)
+        # Training draws new directions, evaluation then keeps the last ones
+        training = wd.loss(X, Y)
+        self.assertNotEqual(training, first)
+        with torch.no_grad():
+            self.assertEqual(wd.loss(X, Y), training)
+
+    def test_global_rng_untouched(self):
+        X, Y = correlated_views(32, 4, seed=0)
+        state = torch.get_rng_state()
+        sliced_wasserstein(8, seed=0).loss(X, Y)
+        self.assertTrue(torch.equal(torch.get_rng_state(), state))
+
+    def test_seeded(self):
+        X, Y = correlated_views(32, 4, seed=0)
+        self.assertEqual(sliced_wasserstein(8, seed=3).loss(X, Y), sliced_wasserstein(8, seed=3).loss(X, Y))
+
+
+if __name__ == '__main__':
+    unittest.main()
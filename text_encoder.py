@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import threading
+import time
+import numpy as np
+import torch
+from scipy.stats import zscore
+
+from config import TEXT_LEN, PRE_TRAINED_MODEL_NAME, CACHE_DIR
+
+
+# --- Process-wide registry: every text_llm / tokenizer is loaded at most once, on first use,
+# and shared by all datasets. DataLoader workers forked afterwards inherit it copy-on-write.
+_encoders = {}
+_tokenizers = {}
+_registry_lock = threading.Lock()
+
+
+def load_text_encoder(text_llm):
+    from transformers import BertModel, BertForSequenceClassification
+
+    if text_llm == 'bert':
+        encoder = BertModel.from_pretrained(PRE_TRAINED_MODEL_NAME)
+    elif text_llm == 'seqbert':
+        encoder = BertForSequenceClassification.from_pretrained(PRE_TRAINED_MODEL_NAME)
+    elif text_llm == 'bert-int8':
+        # Dynamic int8 quantization of every Linear layer, for faster embedding on CPU
+        encoder = BertModel.from_pretrained(PRE_TRAINED_MODEL_NAME).eval()
+        encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        raise Exception('text_llm can only be one of "bert", "seqbert" or "bert-int8"')
+    encoder.eval()
+    return encoder
+
+
+def get_text_encoder(text_llm):
+    with _registry_lock:
+        if text_llm not in _encoders:
+            _encoders[text_llm] = load_text_encoder(text_llm)
+        return _encoders[text_llm]
+
+
+def get_tokenizer(name=PRE_TRAINED_MODEL_NAME):
+    from transformers import BertTokenizerFast
+
+    with _registry_lock:
+        if name not in _tokenizers:
+            _tokenizers[name] = BertTokenizerFast.from_pretrained(name)
+        return _tokenizers[name]
+
+
+def encode_sentences(sentences, text_llm, batch_size=32):
+    """
+        Args: list of sentences, text_llm name
+        Return: float32 array (len(sentences), TEXT_LEN) of z-scored, mask-averaged last hidden states
+    """
+    encoder = get_text_encoder(text_llm)
+    tokenizer = get_tokenizer()
+
+    embeddings = np.zeros((len(sentences), TEXT_LEN), dtype=np.float32)
+    for start in range(0, len(sentences), batch_size):
+        batch = sentences[start:start + batch_size]
+        tokenized = tokenizer(batch, padding=True, truncation=True, return_tensors='pt')
+        with torch.no_grad():
+            outputs = encoder(input_ids=tokenized['input_ids'],
+                              attention_mask=tokenized['attention_mask'],
+                              output_hidden_states=True)
+        # Mean over real tokens only, so padding does not change a sentence's embedding
+        mask = tokenized['attention_mask'].unsqueeze(-1).float()
+        hidden = outputs.hidden_states[-1]
+        mean = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        embeddings[start:start + len(batch)] = mean.numpy()
+
+    embeddings = zscore(embeddings, axis=1)
+    assert embeddings.shape == (len(sentences), TEXT_LEN)
+    return embeddings
+
+
+def compare_text_encoders(sentences, candidate, reference='bert', batch_size=32):
+    """
+        Encodes the sentences with both text_llms (e.g. 'bert-int8' against fp32 'bert').
+        Return: dict with the encoding time of each and the per-sentence cosine similarity
+    """
+    times = {}
+    embeddings = {}
+    for text_llm in [reference, candidate]:
+        get_text_encoder(text_llm)
+        start = time.time()
+        embeddings[text_llm] = encode_sentences(sentences, text_llm, batch_size)
+        times[text_llm] = time.time() - start
+
+    a, b = embeddings[reference], embeddings[candidate]
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return {
+        'reference_seconds' : times[reference],
+        'candidate_seconds' : times[candidate],
+        'speedup' : times[reference] / times[candidate],
+        'cosine_mean' : float(cosine.mean()),
+        'cosine_min' : float(cosine.min())
+    }
+
+
+class SentenceEmbeddingStore():
+    '''
+        Memory-mapped store of z-scored sentence embeddings. Every distinct sentence is encoded
+        once and looked up by a hash of (text_llm, sentence) afterwards, so a rerun over the same
+        sentences never loads the encoder.
+    '''
+
+    def __init__(self, text_llm, cache_dir=CACHE_DIR, batch_size=32):
+        self.text_llm = text_llm
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.path = os.path.join(cache_dir, f'{text_llm}_sentence_embeddings.npy')
+        self.index_path = os.path.join(cache_dir, f'{text_llm}_sentence_embeddings.json')
+
+        self.index = {}
+        if os.path.exists(self.path) and os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def key(self, sentence):
+        return hashlib.sha1(f'{self.text_llm}\n{sentence}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, sentences):
+        """
+            Args: list of sentences
+            Return: float32 array of shape (len(sentences), TEXT_LEN), row i belongs to sentences[i]
+        """
+        keys = [self.key(sentence) for sentence in sentences]
+        missing = {}
+        for key, sentence in zip(keys, sentences):
+            if key not in self.index:
+                missing[key] = sentence
+        if missing:
+            self._add(list(missing.keys()), list(missing.values()))
+
+        embeddings = np.load(self.path, mmap_mode='r')
+        rows = [self.index[key] for key in keys]
+        return np.asarray(embeddings[rows], dtype=np.float32)
+
+    def _add(self, keys, sentences):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        new_embeddings = encode_sentences(sentences, self.text_llm, self.batch_size)
+
+        n_old = len(self.index)
+        tmp_path = self.path + '.tmp.npy'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                        shape=(n_old + len(sentences), TEXT_LEN))
+        if n_old > 0:
+            out[:n_old] = np.load(self.path, mmap_mode='r')[:n_old]
+        out[n_old:] = new_embeddings
+        out.flush()
+        del out
+        os.replace(tmp_path, self.path)
+
+        for i, key in enumerate(keys):
+            self.index[key] = n_old + i
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)